@@ -22,9 +22,15 @@ setuptools.setup(
         'cognitojwt>=1.2.2',
         'dateparser>=0.7.4',
         'firefly-dependency-injection>=0.1',
+        'firefly-framework>=1.0.30',
+        'inflection>=0.3.1',
         'requests>=2.23.0',
         'troposphere>=2.6.1',
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.13.0'],
+        'test': ['pytest>=7.0'],
+    },
     packages=setuptools.PEP420PackageFinder.find('src'),
     package_dir={'': 'src'},
     classifiers=[
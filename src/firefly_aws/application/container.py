@@ -14,6 +14,8 @@
 
 from __future__ import annotations
 
+import os
+
 import boto3
 import firefly_di as di
 
@@ -30,9 +32,13 @@ class Container(di.Container):
     lambda_client = lambda self: boto3.client('lambda')
     sns_client = lambda self: boto3.client('sns')
     sqs_client = lambda self: boto3.client('sqs')
-    rds_data_client = lambda self: boto3.client('rds-data')
+    rds_data_client = lambda self: infra.SqliteRdsDataClient(os.environ['FIREFLY_AWS_DATA_API_SQLITE']) \
+        if 'FIREFLY_AWS_DATA_API_SQLITE' in os.environ else boto3.client('rds-data')
 
     s3_service: infra.BotoS3Service = infra.BotoS3Service
+    data_api_unit_of_work: infra.DataApiUnitOfWork = infra.DataApiUnitOfWork
+    data_api_instrumentation: infra.DataApiInstrumentation = lambda self: self.build(infra.DataApiInstrumentation) \
+        if 'FIREFLY_AWS_DATA_API_INSTRUMENTATION' in os.environ else None
     lambda_executor: domain.LambdaExecutor = domain.LambdaExecutor
     message_transport: ff.MessageTransport = infra.BotoMessageTransport
     jwt_decoder: domain.JwtDecoder = infra.CognitoJwtDecoder
@@ -13,3 +13,4 @@
 #  <http://www.gnu.org/licenses/>.
 
 from .authenticating_middleware import AuthenticatingMiddleware
+from .data_api_transaction_middleware import DataApiTransactionMiddleware
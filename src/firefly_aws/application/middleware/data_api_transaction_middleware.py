@@ -0,0 +1,46 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import firefly as ff
+import firefly_aws.infrastructure as infra
+
+
+@ff.register_middleware(replace=ff.TransactionHandlingMiddleware)
+class DataApiTransactionMiddleware(ff.TransactionHandlingMiddleware):
+    """
+    Transaction handling that queues the writes the repositories make on commit in the Data API unit of work and
+    flushes them, one transaction per storage interface, before the buffered events are dispatched. Nothing is
+    dispatched when the flush fails.
+    """
+    _data_api_unit_of_work: infra.DataApiUnitOfWork = None
+
+    def _commit(self):
+        self._data_api_unit_of_work.begin()
+        try:
+            for repository in self._registry.get_repositories():
+                self.debug('Committing repository %s', repository)
+                repository.commit()
+            self.debug('Committing Data API unit of work')
+            self._data_api_unit_of_work.commit()
+        except Exception as e:
+            self.debug('Rolling back Data API unit of work')
+            self._data_api_unit_of_work.rollback()
+            # __call__ takes the level back down to 0 and resets the repositories.
+            self._level += 1
+            raise e
+
+        self.debug('Dispatching events %s', [{e: e.to_dict() for e in self._event_buffer}])
+        list(map(lambda e: self.dispatch(e), self._event_buffer))
@@ -14,6 +14,8 @@
 
 from .data_api_mysql_mapped_storage_interface import DataApiMysqlMappedStorageInterface
 from .data_api_mysql_storage_interface import DataApiMysqlStorageInterface
+from .data_api_instrumentation import DataApiInstrumentation
+from .data_api_unit_of_work import DataApiUnitOfWork
 from .s3_connection_factory import S3ConnectionFactory
 from .s3_repository import S3Repository
 from .s3_repository_factory import S3RepositoryFactory
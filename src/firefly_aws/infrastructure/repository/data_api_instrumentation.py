@@ -0,0 +1,182 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+import re
+from bisect import bisect_left
+from threading import Lock
+from time import time
+
+import firefly as ff
+
+
+class DataApiInstrumentation(ff.LoggerAware):
+    """
+    Records every Data API statement per SQL template: latency, rows returned, response bytes, retried failures and
+    response size limit errors (which send the storage interfaces down their fallback paths). Running totals are
+    available from stats(). The figures gathered since the last export are written as CloudWatch Embedded Metric
+    Format lines by emit(), which runs automatically every _emit_interval seconds when that is set.
+
+    The container only provides it when FIREFLY_AWS_DATA_API_INSTRUMENTATION is set. Subclass and register the
+    subclass as data_api_instrumentation in the container to change the settings or send the figures somewhere else.
+    """
+    _namespace: str = 'Firefly/DataApi'
+    _emit_interval: int = 60  # In seconds, None to only emit on request
+    _template_length: int = 200
+    _buckets: tuple = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)  # Latency in ms
+
+    def __init__(self):
+        self._lock = Lock()
+        self._totals = {}
+        self._window = {}
+        self._last_emit = time()
+
+    def record(self, sql: str, latency: float, rows: int = 0, bytes_: int = 0):
+        """
+        :param latency: In seconds
+        """
+        self._update(sql, latency, rows=rows, bytes_=bytes_)
+
+    def record_error(self, sql: str, latency: float, size_limit: bool = False):
+        if size_limit:
+            self._update(sql, latency, fallbacks=1)
+        else:
+            self._update(sql, latency, retries=1)
+
+    def stats(self):
+        """
+        Running totals per template since the process started.
+        """
+        with self._lock:
+            return {template: self._snapshot(stats) for template, stats in self._totals.items()}
+
+    def percentile(self, sql: str, p: float):
+        """
+        Latency in ms below which p percent of the statements for a template completed, to bucket precision.
+        """
+        with self._lock:
+            stats = self._totals.get(self._template(sql))
+            if stats is None or stats['count'] == 0:
+                return None
+            target = stats['count'] * p / 100
+            seen = 0
+            for bound, count in zip(self._buckets + (stats['max'],), stats['histogram']):
+                seen += count
+                if seen >= target:
+                    return min(bound, stats['max'])
+            return stats['max']
+
+    def emit(self):
+        """
+        Print the figures gathered since the last export as Embedded Metric Format lines, one per template.
+        """
+        with self._lock:
+            window, self._window = self._window, {}
+            self._last_emit = time()
+
+        for line in self.export(window):
+            print(line, flush=True)
+
+    def export(self, window: dict):
+        timestamp = int(time() * 1000)
+        ret = []
+        for template, stats in window.items():
+            values = [b for b, c in zip(self._buckets + (stats['max'],), stats['histogram']) if c > 0]
+            counts = [c for c in stats['histogram'] if c > 0]
+            ret.append(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self._namespace,
+                        'Dimensions': [['Template']],
+                        'Metrics': [
+                            {'Name': 'Statements', 'Unit': 'Count'},
+                            {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                            {'Name': 'Rows', 'Unit': 'Count'},
+                            {'Name': 'ResponseBytes', 'Unit': 'Bytes'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'Fallbacks', 'Unit': 'Count'},
+                        ],
+                    }],
+                },
+                'Template': template,
+                'Statements': stats['count'],
+                'Latency': {
+                    'Values': values,
+                    'Counts': counts,
+                    'Min': stats['min'],
+                    'Max': stats['max'],
+                    'Sum': stats['latency'],
+                    'Count': stats['count'],
+                },
+                'Rows': stats['rows'],
+                'ResponseBytes': stats['bytes'],
+                'Retries': stats['retries'],
+                'Fallbacks': stats['fallbacks'],
+            }))
+        return ret
+
+    def _update(self, sql: str, latency: float, rows: int = 0, bytes_: int = 0, retries: int = 0,
+                fallbacks: int = 0):
+        template = self._template(sql)
+        ms = latency * 1000
+        bucket = bisect_left(self._buckets, ms)
+
+        with self._lock:
+            for stats in (self._totals.setdefault(template, self._new_stats()),
+                          self._window.setdefault(template, self._new_stats())):
+                stats['count'] += 1
+                stats['latency'] += ms
+                stats['min'] = ms if stats['min'] is None else min(stats['min'], ms)
+                stats['max'] = ms if stats['max'] is None else max(stats['max'], ms)
+                stats['histogram'][bucket] += 1
+                stats['rows'] += rows
+                stats['bytes'] += bytes_
+                stats['retries'] += retries
+                stats['fallbacks'] += fallbacks
+            due = self._emit_interval is not None and time() - self._last_emit >= self._emit_interval
+
+        if due:
+            self.emit()
+
+    def _template(self, sql: str):
+        """
+        The statement with numeric literals (LIMIT values, SUBSTR offsets) replaced by ? and runs of numbered
+        placeholder lists collapsed, so each statement shape is one template and one CloudWatch dimension value.
+        """
+        ret = re.sub(r'(?<![\w.$:])\d+(\.\d+)?', '?', ' '.join(sql.split()))
+        ret = re.sub(r':([A-Za-z_]+)\d+\b', r':\1', ret)
+        ret = re.sub(r'\((:\w+)(\s*,\s*\1)*\)', r'(\1, ...)', ret)
+        return ret[:self._template_length]
+
+    def _new_stats(self):
+        return {
+            'count': 0,
+            'latency': 0.0,
+            'min': None,
+            'max': None,
+            'histogram': [0] * (len(self._buckets) + 1),
+            'rows': 0,
+            'bytes': 0,
+            'retries': 0,
+            'fallbacks': 0,
+        }
+
+    @staticmethod
+    def _snapshot(stats: dict):
+        ret = dict(stats)
+        ret['histogram'] = list(stats['histogram'])
+        return ret
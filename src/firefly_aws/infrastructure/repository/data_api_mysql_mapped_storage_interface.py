@@ -15,7 +15,7 @@
 from __future__ import annotations
 
 from dataclasses import fields
-from typing import Type
+from typing import Type, List
 
 import firefly as ff
 from firefly import domain as ffd
@@ -42,6 +42,9 @@ class DataApiMysqlMappedStorageInterface(DataApiStorageInterface):
         except KeyError:
             return 1
 
+    def _primary_key(self, entity: Type[ff.Entity]):
+        return entity.id_name()
+
     def _get_table_indexes(self, entity: Type[ffd.Entity]):
         schema, table = self._fqtn(entity).split('.')
         sql = f"""
@@ -89,18 +92,17 @@ class DataApiMysqlMappedStorageInterface(DataApiStorageInterface):
         return self._cache['parts']['values'][entity]
 
     def _generate_parameters(self, entity: ff.Entity, part: str = None):
-        params = []
-        for field_ in fields(entity):
-            if 'hidden' in field_.metadata:
-                continue
-            params.append(self._generate_param_entry(field_.name, field_.type, getattr(entity, field_.name)))
-        return params
+        return [encode(getattr(entity, name)) for name, encode in self._get_parameter_encoders(entity.__class__)]
+
+    def _get_parameter_fields(self, entity: Type[ffd.Entity]):
+        return self._visible_fields(entity)
 
     def _generate_update_list(self, entity: Type[ffd.Entity]):
-        values = ['obj=:obj']
-        for index in self.get_indexes(entity):
-            values.append(f'`{index.name}`=:{index.name}')
-        return ','.join(values)
+        if entity not in self._cache['parts']['update']:
+            values = list(map(lambda f: f'`{f.name}`=:{f.name}', self._visible_fields(entity)))
+            self._cache['parts']['update'][entity] = ','.join(values)
+
+        return self._cache['parts']['update'][entity]
 
     def _generate_select_list(self, entity: Type[ffd.Entity]):
         if entity not in self._cache['parts']['select']:
@@ -110,34 +112,68 @@ class DataApiMysqlMappedStorageInterface(DataApiStorageInterface):
         return self._cache['parts']['select'][entity]
 
     def _build_entity(self, entity: Type[ffd.Entity], data, raw: bool = False):
-        params = {}
+        return self._build_page(entity, [data], raw=raw)[0]
 
-        for i, field_ in enumerate(self._visible_fields(entity)):
-            type_ = field_.type
-            if 'isNull' in data[i]:
-                params[field_.name] = None
-                continue
-            elif type_ == 'float' or type_ is float:
-                t = 'doubleValue'
-            elif type_ == 'int' or type_ is int:
-                t = 'longValue'
-            elif type_ == 'bool' or type_ is bool:
-                t = 'booleanValue'
-            elif type_ == 'bytes' or type_ is bytes:
-                t = 'blobValue'
-            else:
-                t = 'stringValue'
+    def _build_page(self, entity: Type[ff.Entity], records: list = None, ids: list = None, raw: bool = False,
+                    projection: List[str] = None):
+        if records is None:
+            return super()._build_page(entity, records, ids, raw, projection)
 
-            params[field_.name] = data[i][t]
+        if projection is not None:
+            decoder = self._get_projection_decoder(entity, projection)
+            return [self._decode_row(decoder, row) for row in records]
 
+        decoder = self._get_row_decoder(entity)
+        rows = [self._decode_row(decoder, row) for row in records]
         if raw:
-            return params
+            return rows
+        return [entity.from_dict(row) for row in rows]
 
-        return entity.from_dict(params)
+    def _get_row_decoder(self, entity: Type[ffd.Entity]):
+        """
+        Field name and Data API value key for each selected column, in column order. Built once per entity so pages
+        can be decoded without looking at the dataclass fields again.
+        """
+        decoders = self._cache.setdefault('decoders', {})
+        if entity not in decoders:
+            decoders[entity] = [(f.name, self._value_key(f.type)) for f in self._visible_fields(entity)]
+        return decoders[entity]
+
+    def _generate_projection_list(self, entity: Type[ffd.Entity], fields_: List[str]):
+        visible = [f.name for f in self._visible_fields(entity)]
+        for field_ in fields_:
+            if field_ not in visible:
+                raise ff.InvalidArgument(f"'{field_}' is not stored in a column of {entity.__name__}")
+        return ','.join(map(lambda f: f'`{f}`', fields_))
+
+    def _build_projection(self, entity: Type[ffd.Entity], fields_: List[str], data: list):
+        return self._decode_row(self._get_projection_decoder(entity, fields_), data)
+
+    def _get_projection_decoder(self, entity: Type[ffd.Entity], fields_: List[str]):
+        keys = dict(self._get_row_decoder(entity))
+        return [(name, keys[name]) for name in fields_]
 
     @staticmethod
-    def _visible_fields(entity: Type[ffd.Entity]):
-        return list(filter(lambda f: 'hidden' not in f.metadata, fields(entity)))
+    def _decode_row(decoder: list, data: list):
+        return {name: None if 'isNull' in cell else cell[key] for (name, key), cell in zip(decoder, data)}
+
+    @staticmethod
+    def _value_key(type_):
+        if type_ == 'float' or type_ is float:
+            return 'doubleValue'
+        elif type_ == 'int' or type_ is int:
+            return 'longValue'
+        elif type_ == 'bool' or type_ is bool:
+            return 'booleanValue'
+        elif type_ == 'bytes' or type_ is bytes:
+            return 'blobValue'
+        return 'stringValue'
+
+    def _visible_fields(self, entity: Type[ffd.Entity]):
+        visible = self._cache.setdefault('visible_fields', {})
+        if entity not in visible:
+            visible[entity] = list(filter(lambda f: 'hidden' not in f.metadata, fields(entity)))
+        return visible[entity]
 
     def _generate_create_table(self, entity: Type[ffd.Entity]):
         columns = []
@@ -173,14 +209,6 @@ class DataApiMysqlMappedStorageInterface(DataApiStorageInterface):
         """
         return sql
 
-    def raw(self, entity: Type[ffd.Entity], criteria: ffd.BinaryOp = None, limit: int = None):
-        sql = f"select {self._generate_select_list(entity)} from {self._fqtn(entity)}"
-        params = []
-        if criteria is not None:
-            clause, params = self._generate_where_clause(criteria)
-            sql = f'{sql} {clause}'
-
-        if limit is not None:
-            sql += f" limit {limit}"
-
-        return self._paginate(sql, params, entity, raw=True)
+    def raw(self, entity: Type[ffd.Entity], criteria: ffd.BinaryOp = None, limit: int = None, stream: bool = False):
+        self._check_prerequisites(entity)
+        return self._all(entity, criteria, limit, stream=stream, raw=True)
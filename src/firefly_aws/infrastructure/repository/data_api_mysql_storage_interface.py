@@ -14,19 +14,47 @@
 
 from __future__ import annotations
 
-from typing import Type
+import base64
+import itertools
+import zlib
+from dataclasses import fields
+from datetime import datetime
+from typing import Type, List
 
 import firefly as ff
 import firefly_aws.domain as domain
 from botocore.exceptions import ClientError
 from firefly import domain as ffd
 
-from .data_api_storage_interface import DataApiStorageInterface
+from .data_api_storage_interface import DataApiStorageInterface, SqlExpression
+
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
 
 
 class DataApiMysqlStorageInterface(DataApiStorageInterface):
-    def __init__(self):
+    def __init__(self, codecs: dict = None, generated_indexes: bool = False):
+        """
+        :param codecs: Optional map of entity name (or fully qualified name) to the codec used to store its obj
+        column: 'zlib' or 'zstd'. Use '*' as the key to set a default for every entity. Each stored document carries a
+        '<codec>:' prefix, so rows written before a codec was configured are still read as plain JSON. To stop
+        compressing an entity, map it to None rather than removing it: rows it still has under the old codec are then
+        found and read in Python instead of being queried as JSON.
+        :param generated_indexes: Declare index columns as virtual columns generated from the obj document instead of
+        writing them on every insert and update. Entities stored with a codec keep regular columns, since MySQL cannot
+        read a compressed document.
+        """
         super().__init__()
+        self._codecs = codecs or {}
+        self._generated_indexes = generated_indexes
+        for codec in self._codecs.values():
+            if codec not in ('zlib', 'zstd', None):
+                raise ff.ConfigurationError(f"Unknown Data API document codec '{codec}'")
+            if codec == 'zstd' and zstandard is None:
+                raise ff.ConfigurationError("The 'zstd' codec requires the zstandard package")
 
     def _add(self, entity: ff.Entity):
         try:
@@ -48,31 +76,180 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
                 return self._fetch_large_document(uuid, entity_type)
             raise e
 
-    def _all(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None, limit: int = None):
+    def _all(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None, limit: int = None,
+             stream: bool = False, raw: bool = False):
+        pushed_criteria, exact = self._push_down(entity_type, criteria)
         try:
-            indexes = [i.name for i in self.get_indexes(entity_type)]
-            pruned_criteria = None
-            if criteria is not None:
-                pruned_criteria = criteria.prune(indexes)
-
-            entities = super()._all(entity_type, pruned_criteria, limit)
-            if criteria != pruned_criteria:
-                entities = list(filter(lambda ee: criteria.matches(ee), entities))
-
-            return entities
+            # Without an exact translation the limit has to be applied after filtering.
+            entities = super()._all(entity_type, pushed_criteria, limit if exact else None, stream=stream,
+                                    raw=raw)
         except ClientError as e:
-            if 'Database returned more than the allowed response size limit' in str(e):
-                sql = f"select {self._generate_select_list(entity_type)} from {self._fqtn(entity_type)}"
-                params = []
-                if criteria is not None:
-                    clause, params = self._generate_where_clause(criteria)
-                    sql = f'{sql} {clause}'
+            if 'Database returned more than the allowed response size limit' not in str(e):
+                raise e
+            sql = f"select {self._generate_select_list(entity_type)} from {self._fqtn(entity_type)}"
+            clause, params = self._generate_where_clause(pushed_criteria)
+            sql = f'{sql} {clause}'
+            if limit is not None and exact:
+                sql += f" limit {limit}"
+            entities = self._fetch_multiple_large_documents(sql, params, entity_type, raw=raw)
+
+        if not exact:
+            entities = filter(lambda ee: criteria.matches(ee), entities)
+            if limit is not None:
+                entities = itertools.islice(entities, limit)
+
+        return entities if stream else list(entities)
+
+    def _remove_where(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp):
+        pushed_criteria, exact = self._push_down(entity_type, criteria)
+        if exact:
+            return super()._remove_where(entity_type, pushed_criteria)
+
+        count = 0
+        ids = []
+        for entity in self._all(entity_type, criteria, stream=True):
+            ids.append(entity.id_value())
+            if len(ids) >= self._delete_batch_size:
+                count += self._remove_ids(entity_type, ids)
+                ids = []
+        return count + self._remove_ids(entity_type, ids)
+
+    def _project(self, entity_type: Type[ff.Entity], fields_: List[str], criteria: ff.BinaryOp = None,
+                 limit: int = None):
+        pushed_criteria, exact = self._push_down(entity_type, criteria)
+        if exact and self._documents_are_json(entity_type):
+            return super()._project(entity_type, fields_, pushed_criteria, limit)
+
+        # The documents have to be read in full, either to finish filtering or to decompress them.
+        documents = self._all(entity_type, criteria, limit, stream=True, raw=True)
+        return map(lambda doc: {f: doc.get(f) for f in fields_}, documents)
+
+    def _aggregate(self, entity_type: Type[ff.Entity], aggregates: dict, criteria: ff.BinaryOp = None,
+                   group_by: List[str] = None):
+        pushed_criteria, exact = self._push_down(entity_type, criteria)
+        if exact and self._documents_are_json(entity_type):
+            return super()._aggregate(entity_type, aggregates, pushed_criteria, group_by)
+
+        documents = self._all(entity_type, criteria, stream=True, raw=True)
+        return self._aggregate_documents(documents, aggregates, group_by)
+
+    def _aggregate_column(self, entity: Type[ff.Entity], name: str):
+        if name in [i.name for i in self.get_indexes(entity)]:
+            return f'`{name}`'
+
+        field_ = [f for f in fields(entity) if f.name == name][0]
+        if field_.type in ('int', 'float', int, float):
+            return f'({self._generated_expression(field_)} + 0)'
+        return self._generated_expression(field_)
+
+    @staticmethod
+    def _aggregate_documents(documents, aggregates: dict, group_by: List[str]):
+        """
+        Aggregate raw documents in memory, for criteria or documents that MySQL cannot evaluate. Only a running count
+        and value is kept per group.
+        """
+        groups = {}
+        for doc in documents:
+            key = tuple(doc.get(name) for name in group_by)
+            if key not in groups:
+                groups[key] = {name: [0, None] for name in aggregates.keys()}
+            for name, (function, field_) in aggregates.items():
+                value = 1 if field_ is None else doc.get(field_)
+                if value is None:
+                    continue
+                state = groups[key][name]
+                state[0] += 1
+                if state[1] is None:
+                    state[1] = value
+                elif function in ('sum', 'avg'):
+                    state[1] += value
+                elif function == 'min':
+                    state[1] = min(state[1], value)
+                elif function == 'max':
+                    state[1] = max(state[1], value)
+
+        if len(group_by) == 0 and len(groups) == 0:
+            groups[()] = {name: [0, None] for name in aggregates.keys()}
 
-                if limit is not None:
-                    sql += f" limit {limit}"
+        ret = []
+        for key in sorted(groups.keys(), key=lambda k: tuple((v is not None, v) for v in k)):
+            row = dict(zip(group_by, key))
+            for name, (function, field_) in aggregates.items():
+                count, value = groups[key][name]
+                if function == 'count':
+                    row[name] = count
+                elif function == 'avg':
+                    row[name] = None if count == 0 else value / count
+                else:
+                    row[name] = value
+            ret.append(row)
+        return ret
 
-                return self._fetch_multiple_large_documents(sql, params, entity_type)
-            raise e
+    def _push_down(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None):
+        """
+        Translate criteria so MySQL can evaluate all of it. Indexed fields are compared on their own columns and other
+        scalar fields are read from the obj document with JSON_EXTRACT. Comparisons that cannot be expressed this way
+        (collections, booleans, null checks, compressed documents) become a tautology, which widens the result.
+
+        Returns the translated criteria and whether the translation is exact. When it is not, the caller has to
+        filter the rows with the original criteria.
+        """
+        if criteria is None:
+            return None, True
+
+        indexes = [i.name for i in self.get_indexes(entity_type)]
+        documents = self._get_document_paths(entity_type)
+        exact = True
+
+        def column(attr):
+            name, functions = self._attribute(attr)
+            if name in indexes:
+                return attr
+            if name in documents:
+                return SqlExpression(self._apply_functions(documents[name], functions))
+            return None
+
+        def translate(bop: ff.BinaryOp):
+            nonlocal exact
+            if bop.op in ('and', 'or'):
+                return ff.BinaryOp(
+                    translate(bop.lhv) if isinstance(bop.lhv, ff.BinaryOp) else bop.lhv,
+                    bop.op,
+                    translate(bop.rhv) if isinstance(bop.rhv, ff.BinaryOp) else bop.rhv
+                )
+
+            sides = []
+            for side in (bop.lhv, bop.rhv):
+                if isinstance(side, (ff.Attr, ff.AttributeString)):
+                    translated = column(side)
+                    if translated is None or (translated is not side and bop.op in ('is', 'contains')):
+                        exact = False
+                        return ff.BinaryOp(1, '==', 1)
+                    side = translated
+                sides.append(side)
+            return ff.BinaryOp(sides[0], bop.op, sides[1])
+
+        ret = translate(criteria)
+        return ret, exact
+
+    def _get_document_paths(self, entity_type: Type[ff.Entity]):
+        """
+        SQL expressions that read each scalar field of an entity from the obj document. Compressed documents cannot
+        be read by MySQL, so entities with a codec get none.
+        """
+        self._cache.setdefault('document_paths', {})
+        if entity_type not in self._cache['document_paths']:
+            ret = {}
+            if self._documents_are_json(entity_type):
+                for field_ in fields(entity_type):
+                    t = field_.type if isinstance(field_.type, str) else getattr(field_.type, '__name__', None)
+                    if t in ('int', 'float'):
+                        ret[field_.name] = f"JSON_EXTRACT(obj, '$.{field_.name}')"
+                    elif t in ('str', 'datetime', 'date'):
+                        ret[field_.name] = f"JSON_UNQUOTE(JSON_EXTRACT(obj, '$.{field_.name}'))"
+            self._cache['document_paths'][entity_type] = ret
+
+        return self._cache['document_paths'][entity_type]
 
     def _get_average_row_size(self, entity: Type[ff.Entity]):
         result = ff.retry(
@@ -104,7 +281,7 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
 
     def _add_table_index(self, entity: Type[ffd.Entity], field_):
         ff.retry(lambda: self._exec(
-            f"alter table {self._fqtn(entity)} add column `{field_.name}` {self._db_type(field_)}", []
+            f"alter table {self._fqtn(entity)} add column {self._column_declaration(entity, field_)}", []
         ))
         ff.retry(lambda: self._exec(f"create index `idx_{field_.name}` on {self._fqtn(entity)} (`{field_.name}`)", []))
 
@@ -112,21 +289,99 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
         ff.retry(lambda: self._exec(f"drop index `idx_{name}` on {self._fqtn(entity)}", []))
         ff.retry(lambda: self._exec(f"alter table {self._fqtn(entity)} drop column `{name}`", []))
 
+    def _execute_ddl(self, entity: Type[ffd.Entity]):
+        super()._execute_ddl(entity)
+
+        # Index columns that exist with the wrong kind are rebuilt.
+        generated = self._get_generated_columns(entity)
+        for field_ in self._get_indexes(entity):
+            if self._is_generated(entity) and field_.name not in generated:
+                self._drop_table_index(entity, field_.name)
+                self._add_table_index(entity, field_)
+            elif not self._is_generated(entity) and field_.name in generated:
+                self._materialize_table_index(entity, field_)
+
+    def _materialize_table_index(self, entity: Type[ffd.Entity], field_):
+        """
+        Replace a virtual generated index column with a regular one. MySQL cannot modify a virtual column into a
+        stored one, so the values are copied into a new column, which then takes the old column's place.
+        """
+        table = self._fqtn(entity)
+        tmp = f'{field_.name}__regular'
+        ff.retry(lambda: self._exec(
+            f"alter table {table} add column {self._column_declaration(entity, field_, name=tmp)}", []
+        ))
+        ff.retry(lambda: self._exec(f"update {table} set `{tmp}` = {self._generated_expression(field_)}", []))
+        self._drop_table_index(entity, field_.name)
+        ff.retry(lambda: self._exec(
+            f"alter table {table} change column `{tmp}` {self._column_declaration(entity, field_)}", []
+        ))
+        ff.retry(lambda: self._exec(f"create index `idx_{field_.name}` on {table} (`{field_.name}`)", []))
+
+    def _get_generated_columns(self, entity: Type[ffd.Entity]):
+        schema, table = self._fqtn(entity).split('.')
+        sql = f"""
+            select COLUMN_NAME
+            from information_schema.COLUMNS
+            where TABLE_NAME = '{table}'
+            and TABLE_SCHEMA = '{schema}'
+            and EXTRA like '%GENERATED%'
+        """
+        result = ff.retry(
+            lambda: self._exec(sql, [])
+        )
+
+        return [row[0]['stringValue'] for row in result['records']]
+
+    def _is_generated(self, entity: Type[ffd.Entity]):
+        return self._generated_indexes and self._get_codec(entity) is None
+
+    def _get_parameter_fields(self, entity: Type[ffd.Entity]):
+        return self._get_written_indexes(entity)
+
+    def _get_written_indexes(self, entity: Type[ffd.Entity]):
+        if self._is_generated(entity):
+            return []
+        return self.get_indexes(entity)
+
+    @staticmethod
+    def _generated_expression(field_):
+        # JSON null has to become SQL NULL, otherwise it is stored as the string 'null'. Large documents are written
+        # in chunks, so obj is not valid JSON until the last chunk is appended.
+        return f"JSON_UNQUOTE(NULLIF(CASE WHEN JSON_VALID(obj) THEN JSON_EXTRACT(obj, '$.{field_.name}') END, " \
+               f"CAST('null' AS JSON)))"
+
+    def _column_declaration(self, entity: Type[ffd.Entity], field_, name: str = None):
+        name = name or field_.name
+        if field_.type == 'float' or field_.type is float:
+            ret = f"`{name}` float"
+        elif field_.type == 'int' or field_.type is int:
+            ret = f"`{name}` integer"
+        elif field_.type == 'datetime' or field_.type is datetime:
+            ret = self._datetime_declaration(name)
+        else:
+            length = field_.metadata['length'] if 'length' in field_.metadata else 256
+            ret = f"`{name}` varchar({length})"
+
+        if self._is_generated(entity):
+            ret += f" generated always as ({self._generated_expression(field_)}) virtual"
+        return ret
+
     def _generate_column_list(self, entity: Type[ffd.Entity]):
         values = ['id', 'obj']
-        for index in self.get_indexes(entity):
+        for index in self._get_written_indexes(entity):
             values.append(index.name)
         return ','.join(values)
 
     def _generate_value_list(self, entity: Type[ffd.Entity]):
         placeholders = [':id', ':obj']
-        for index in self.get_indexes(entity):
+        for index in self._get_written_indexes(entity):
             placeholders.append(f':{index.name}')
         return ','.join(placeholders)
 
     def _generate_parameters(self, entity: ff.Entity, part: str = None):
         if part is None:
-            obj = self._serializer.serialize(entity)
+            obj = self._encode_document(entity)
             if (len(obj) / 1024) >= self._size_limit:
                 raise domain.DocumentTooLarge()
         else:
@@ -136,18 +391,16 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
             {'name': 'id', 'value': {'stringValue': entity.id_value()}},
             {'name': 'obj', 'value': {'stringValue': obj}},
         ]
-        for field_ in self._get_indexes(entity.__class__):
-            params.append(self._generate_param_entry(field_.name, field_.type, getattr(entity, field_.name)))
-        return params
+        return self._add_index_params(entity, params)
 
     def _generate_update_list(self, entity: Type[ffd.Entity]):
         values = ['obj=:obj']
-        for index in self.get_indexes(entity):
+        for index in self._get_written_indexes(entity):
             values.append(f'`{index.name}`=:{index.name}')
         return ','.join(values)
 
     def _insert_large_document(self, entity: ff.Entity, update: bool = False):
-        obj = self._serializer.serialize(entity)
+        obj = self._encode_document(entity)
         n = self._size_limit * 1024
         first = True
         for chunk in [obj[i:i+n] for i in range(0, len(obj), n)]:
@@ -165,50 +418,136 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
                 ]
                 ff.retry(lambda: self._exec(sql, params))
 
-    def _fetch_large_document(self, id_: str, entity: Type[ff.Entity]):
+    def _fetch_large_document(self, id_: str, entity: Type[ff.Entity], raw: bool = False):
+        ret = self._fetch_large_documents([id_], entity, raw=raw)
+        return ret[0] if len(ret) > 0 else None
+
+    def _fetch_large_documents(self, ids: list, entity: Type[ff.Entity], raw: bool = False):
+        """
+        Read documents that are too large for one response. The character length of each document is fetched
+        first, then every SUBSTR range of every document is requested concurrently and the pieces are joined in
+        order.
+        """
+        if len(ids) == 0:
+            return []
+
         n = self._size_limit * 1024
-        start = 1
-        document = ''
-        while True:
-            sql = f"select SUBSTR(obj, {start}, {n}) as obj from {self._fqtn(entity)} where id = :id"
-            params = [{'name': 'id', 'value': {'stringValue': id_}}]
-            # result = ff.retry(self._exec(sql, params))
-            result = self._exec(sql, params)
-            document += result['records'][0][0]['stringValue']
-            if len(result['records'][0][0]['stringValue']) < n:
-                break
-            start += n
-
-        return entity.from_dict(self._serializer.deserialize(document))
-
-    def _fetch_multiple_large_documents(self, sql: str, params: list, entity: Type[ff.Entity]):
+        placeholders = ','.join(map(lambda i: f':id{i}', range(len(ids))))
+        sql = f"select id, CHAR_LENGTH(obj) from {self._fqtn(entity)} where id in ({placeholders})"
+        params = [{'name': f'id{i}', 'value': {'stringValue': id_}} for i, id_ in enumerate(ids)]
+        result = ff.retry(lambda: self._exec(sql, params))
+        lengths = {row[0]['stringValue']: row[1]['longValue'] for row in result['records']}
+
         ret = []
+        with self._executor(self._page_concurrency) as executor:
+            chunks = {}
+            for id_ in ids:
+                if id_ in lengths:
+                    chunks[id_] = [
+                        executor.submit(self._fetch_document_chunk, entity, id_, start, n)
+                        for start in range(1, max(lengths[id_], 1) + 1, n)
+                    ]
+
+            for id_ in ids:
+                if id_ not in chunks:
+                    continue
+                obj = self._decode_document(''.join([future.result() for future in chunks.pop(id_)]))
+                ret.append(obj if raw else entity.from_dict(obj))
+
+        return ret
+
+    def _fetch_document_chunk(self, entity: Type[ff.Entity], id_: str, start: int, length: int):
+        sql = f"select SUBSTR(obj, {start}, {length}) as obj from {self._fqtn(entity)} where id = :id"
+        params = [{'name': 'id', 'value': {'stringValue': id_}}]
+        result = ff.retry(
+            lambda: self._exec(sql, params),
+            should_retry=lambda err: 'Database returned more than the allowed response size limit' not in str(err)
+        )
+        return result['records'][0][0]['stringValue']
+
+    def _fetch_multiple_large_documents(self, sql: str, params: list, entity: Type[ff.Entity], raw: bool = False):
         sql = sql.replace('select obj', 'select id')
         result = ff.retry(lambda: self._exec(sql, params))
-        for row in result['records']:
-            ret.append(self._fetch_large_document(row[0]['stringValue'], entity))
-        return ret
+        return self._fetch_large_documents([row[0]['stringValue'] for row in result['records']], entity, raw=raw)
+
+    def _load_oversized_page(self, entity: Type[ff.Entity], ids: list, raw: bool = False):
+        return self._fetch_large_documents(ids, entity, raw=raw)
 
     def _build_entity(self, entity: Type[ffd.Entity], data, raw: bool = False):
-        return entity.from_dict(self._serializer.deserialize(data[0]['stringValue']))
+        obj = self._decode_document(data[0]['stringValue'])
+        if raw:
+            return obj
+        return entity.from_dict(obj)
 
     def _generate_select_list(self, entity: Type[ffd.Entity]):
         return 'obj'
 
+    def _generate_projection_list(self, entity: Type[ffd.Entity], fields_: List[str]):
+        return ','.join(map(lambda f: f"JSON_EXTRACT(obj, '$.{f}')", fields_))
+
+    def _build_projection(self, entity: Type[ffd.Entity], fields_: List[str], data: list):
+        ret = {}
+        for i, field_ in enumerate(fields_):
+            if 'isNull' in data[i]:
+                ret[field_] = None
+            elif 'stringValue' in data[i]:
+                ret[field_] = self._serializer.deserialize(data[i]['stringValue'])
+            else:
+                # Engines other than MySQL may return JSON scalars typed.
+                ret[field_] = list(data[i].values())[0]
+        return ret
+
+    def _get_codec(self, entity: Type[ffd.Entity]):
+        if entity.__name__ in self._codecs:
+            return self._codecs[entity.__name__]
+        if entity.get_fqn() in self._codecs:
+            return self._codecs[entity.get_fqn()]
+        return self._codecs.get('*')
+
+    def _documents_are_json(self, entity: Type[ffd.Entity]):
+        """
+        Whether MySQL can read every obj document of an entity as JSON. An entity mapped to None in codecs may still
+        have rows written under a codec, so its table is checked once.
+        """
+        if self._get_codec(entity) is not None:
+            return False
+        if not any(key in self._codecs for key in (entity.__name__, entity.get_fqn(), '*')):
+            return True
+
+        self._cache.setdefault('encoded_documents', {})
+        if entity not in self._cache['encoded_documents']:
+            result = ff.retry(lambda: self._exec(
+                f"select id from {self._fqtn(entity)} where obj like 'zlib:%' or obj like 'zstd:%' limit 1", []
+            ))
+            self._cache['encoded_documents'][entity] = len(result['records']) > 0
+
+        return not self._cache['encoded_documents'][entity]
+
+    def _encode_document(self, entity: ff.Entity):
+        obj = self._serializer.serialize(entity)
+        codec = self._get_codec(entity.__class__)
+        if codec == 'zlib':
+            return 'zlib:' + base64.b64encode(zlib.compress(obj.encode('utf-8'))).decode('ascii')
+        if codec == 'zstd':
+            data = zstandard.ZstdCompressor().compress(obj.encode('utf-8'))
+            return 'zstd:' + base64.b64encode(data).decode('ascii')
+        return obj
+
+    def _decode_document(self, document: str):
+        if document.startswith('zlib:'):
+            document = zlib.decompress(base64.b64decode(document[5:])).decode('utf-8')
+        elif document.startswith('zstd:'):
+            if zstandard is None:
+                raise ff.ConfigurationError("Reading 'zstd' documents requires the zstandard package")
+            document = zstandard.ZstdDecompressor().decompress(base64.b64decode(document[5:])).decode('utf-8')
+        return self._serializer.deserialize(document)
+
     def _generate_create_table(self, entity: Type[ffd.Entity]):
         columns = []
         indexes = []
         for i in self.get_indexes(entity):
             indexes.append(self._generate_index(i.name))
-            if i.type == 'float':
-                columns.append(f"`{i.name}` float")
-            elif i.type == 'int':
-                columns.append(f"`{i.name}` integer")
-            elif i.type == 'datetime':
-                columns.append(self._datetime_declaration(i.name))
-            else:
-                length = i.metadata['length'] if 'length' in i.metadata else 256
-                columns.append(f"`{i.name}` varchar({length})")
+            columns.append(self._column_declaration(entity, i))
         extra = ''
         if len(columns) > 0:
             self._generate_extra(columns, indexes)
@@ -224,5 +563,6 @@ class DataApiMysqlStorageInterface(DataApiStorageInterface):
         """
         return sql
 
-    def raw(self, entity: Type[ffd.Entity], criteria: ffd.BinaryOp = None, limit: int = None):
-        raise NotImplementedError('You cannot call raw() on data api interfaces')
+    def raw(self, entity: Type[ffd.Entity], criteria: ffd.BinaryOp = None, limit: int = None, stream: bool = False):
+        self._check_prerequisites(entity)
+        return self._all(entity, criteria, limit, stream=stream, raw=True)
@@ -15,18 +15,61 @@
 from __future__ import annotations
 
 import itertools
-import multiprocessing.pool
+import json
+import re
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import fields
 from datetime import datetime
+from decimal import Decimal
 from math import floor, ceil
-from typing import Type
+from threading import Lock
+from time import time, perf_counter
+from typing import Type, List
 
 import firefly as ff
 import firefly.infrastructure as ffi
+import firefly_aws.domain as domain
 from botocore.exceptions import ClientError
 from firefly import domain as ffd
 
+from .data_api_instrumentation import DataApiInstrumentation
+from .data_api_unit_of_work import DataApiUnitOfWork
+
+
+class SqlExpression:
+    """
+    SQL standing in for an attribute in search criteria, written out as is by _generate_where_clause.
+    """
+
+    def __init__(self, sql: str):
+        self.sql = sql
+
+
+class _SerialExecutor:
+    """
+    Runs each submitted call straight away on the calling thread. Stands in for a thread pool while a transaction
+    is open, because the Data API does not run statements of one transaction concurrently.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        ret = Future()
+        try:
+            ret.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            ret.set_exception(e)
+        return ret
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
 
 class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
     _cache: dict = None
@@ -35,33 +78,237 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
     _db_arn: str = None
     _db_secret_arn: str = None
     _db_name: str = None
+    _data_api_unit_of_work: DataApiUnitOfWork = None
+    _data_api_instrumentation: DataApiInstrumentation = None
+    _s3_client = None
+    _bucket: str = None
     _size_limit: int = 1000  # In KB
+    _page_fill: float = 0.8
+    _page_concurrency: int = 4
+    _key_scan_size: int = 10000
+    _batch_size_limit: int = 3500  # In KB
+    _delete_batch_size: int = 1000
+    _id_list_limit: int = 1000  # Ids bound in one find_many statement
+    _metadata_ttl: int = 86400  # In seconds
+    _statement_cache_size: int = 1000
+    _aggregate_functions: tuple = ('count', 'sum', 'min', 'max', 'avg')
 
     def __init__(self):
         super().__init__()
         self._select_limits = {}
+        self._row_sizes = {}
+        self._key_scan_limits = {}
+        self._transaction_id = None
+        self._pending = None
+        self._statement_lock = Lock()
 
     def _disconnect(self):
         pass
 
+    def _defer(self, entity_type: Type[ff.Entity], operation: str, *args):
+        """
+        Queue a write while a Data API unit of work is active. Writes are queued per entity type in the order they
+        were made; consecutive writes of the same kind share an entry so they can be flushed as one batch.
+        """
+        if self._data_api_unit_of_work is None or not self._data_api_unit_of_work.is_active():
+            return False
+
+        if self._pending is None:
+            self._pending = {}
+            self._data_api_unit_of_work.enlist(self)
+        queue = self._pending.setdefault(entity_type, [])
+        if len(queue) > 0 and queue[-1][0] == operation:
+            queue[-1][1].extend(args)
+        else:
+            queue.append((operation, list(args)))
+        return True
+
+    def flush(self):
+        """
+        Write all deferred changes in a single transaction, in the order they were made, using the batched write
+        paths.
+        """
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+
+        self.begin_transaction()
+        try:
+            for entity_type, queue in pending.items():
+                for operation, args in queue:
+                    self._write(entity_type, operation, args)
+        except Exception as e:
+            self.rollback_transaction()
+            raise e
+        self.commit_transaction()
+
+    def _write(self, entity_type: Type[ff.Entity], operation: str, args: list):
+        if operation == 'add':
+            self._batch_write(args)
+        elif operation == 'update':
+            self._batch_write(args, update=True)
+        elif operation == 'remove':
+            self._remove_ids(entity_type, [e.id_value() for e in args])
+        elif operation == 'remove_where':
+            for criteria in args:
+                self._remove_where(entity_type, criteria)
+
+    def discard(self):
+        self._pending = None
+        if self._transaction_id is not None:
+            self.rollback_transaction()
+
+    def begin_transaction(self):
+        if self._transaction_id is None:
+            self._transaction_id = self._rds_data_client.begin_transaction(
+                resourceArn=self._db_arn,
+                secretArn=self._db_secret_arn,
+                database=self._db_name
+            )['transactionId']
+            self.debug('Began transaction %s', self._transaction_id)
+        return self._transaction_id
+
+    def commit_transaction(self):
+        transaction_id, self._transaction_id = self._transaction_id, None
+        if transaction_id is not None:
+            self._rds_data_client.commit_transaction(
+                resourceArn=self._db_arn,
+                secretArn=self._db_secret_arn,
+                transactionId=transaction_id
+            )
+            self.debug('Committed transaction %s', transaction_id)
+
+    def rollback_transaction(self):
+        transaction_id, self._transaction_id = self._transaction_id, None
+        if transaction_id is not None:
+            self._rds_data_client.rollback_transaction(
+                resourceArn=self._db_arn,
+                secretArn=self._db_secret_arn,
+                transactionId=transaction_id
+            )
+            self.debug('Rolled back transaction %s', transaction_id)
+
     def _add(self, entity: ff.Entity):
+        if self._defer(entity.__class__, 'add', *self._prepare_writes([entity], self._generate_insert)):
+            return
         sql, params = self._generate_insert(entity)
         ff.retry(lambda: self._exec(sql, params))
 
-    def _all(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None, limit: int = None):
-        sql = f"select {self._generate_select_list(entity_type)} from {self._fqtn(entity_type)}"
-        params = []
-        if criteria is not None:
-            clause, params = self._generate_where_clause(criteria)
-            sql = f'{sql} {clause}'
+    def all(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None, limit: int = None,
+            stream: bool = False):
+        self._check_prerequisites(entity_type)
+        return self._all(entity_type, criteria, limit, stream=stream)
 
-        if limit is not None:
-            sql += f" limit {limit}"
+    def _all(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp = None, limit: int = None,
+             stream: bool = False, raw: bool = False):
+        return self._paginate(entity_type, criteria, raw=raw, stream=stream, max_rows=limit)
 
-        return self._paginate(sql, params, entity_type)
+    def project(self, entity_type: Type[ff.Entity], fields_: List[str], criteria: ff.BinaryOp = None,
+                limit: int = None, stream: bool = False, tuples: bool = False):
+        """
+        Load only the given fields of the matching rows, without building entities. Rows are dicts keyed by field
+        name, or tuples in the order of fields_ when tuples=True.
+        """
+        self._check_prerequisites(entity_type)
+        self._check_fields(entity_type, fields_)
+
+        rows = self._project(entity_type, fields_, criteria, limit)
+        if tuples:
+            rows = map(lambda row: tuple(row[f] for f in fields_), rows)
+        return rows if stream else list(rows)
+
+    def _project(self, entity_type: Type[ff.Entity], fields_: List[str], criteria: ff.BinaryOp = None,
+                 limit: int = None):
+        return self._paginate(entity_type, criteria, stream=True, max_rows=limit, projection=fields_)
+
+    def aggregate(self, entity_type: Type[ff.Entity], aggregates: dict, criteria: ff.BinaryOp = None,
+                  group_by: List[str] = None):
+        """
+        Compute aggregates in the database. aggregates maps a result name to a (function, field) pair, where the
+        function is one of count, sum, min, max or avg, and the field may be None for count. Without group_by one dict
+        of results is returned; with it, a list with one dict per group holding the group_by fields and the results.
+
+            storage.aggregate(Order, {'orders': ('count', None), 'revenue': ('sum', 'total')}, group_by=['status'])
+        """
+        self._check_prerequisites(entity_type)
+        group_by = group_by or []
+        names = list(group_by)
+        for function, field_ in aggregates.values():
+            if function not in self._aggregate_functions:
+                raise ff.InvalidArgument(f"Unknown aggregate function '{function}'")
+            if field_ is None and function != 'count':
+                raise ff.InvalidArgument(f"Aggregate function '{function}' needs a field")
+            if field_ is not None:
+                names.append(field_)
+        self._check_fields(entity_type, names)
+
+        rows = self._aggregate(entity_type, aggregates, criteria, group_by)
+        return rows if len(group_by) > 0 else rows[0]
+
+    def _aggregate(self, entity_type: Type[ff.Entity], aggregates: dict, criteria: ff.BinaryOp = None,
+                   group_by: List[str] = None):
+        select_list = [self._aggregate_column(entity_type, name) for name in group_by]
+        for function, field_ in aggregates.values():
+            column = '*' if field_ is None else self._aggregate_column(entity_type, field_)
+            select_list.append(f'{function}({column})')
+
+        clause, params = self._generate_where_clause(criteria)
+        sql = f"select {','.join(select_list)} from {self._fqtn(entity_type)} {clause}"
+        if len(group_by) > 0:
+            positions = ','.join(map(str, range(1, len(group_by) + 1)))
+            sql += f' group by {positions} order by {positions}'
+        records = ff.retry(lambda: self._exec(sql, params))['records']
+
+        types = {f.name: f.type for f in fields(entity_type)}
+        ret = []
+        for row in records:
+            values = {}
+            for i, name in enumerate(group_by):
+                values[name] = self._read_aggregate(row[i], types[name])
+            for i, (name, (function, field_)) in enumerate(aggregates.items(), start=len(group_by)):
+                if function == 'count':
+                    values[name] = self._read_aggregate(row[i], 'int')
+                elif function == 'avg':
+                    values[name] = self._read_aggregate(row[i], 'float')
+                else:
+                    values[name] = self._read_aggregate(row[i], types[field_])
+            ret.append(values)
+        return ret
+
+    def _aggregate_column(self, entity: Type[ff.Entity], name: str):
+        return f'`{name}`'
+
+    @staticmethod
+    def _read_aggregate(value: dict, type_=None):
+        if 'isNull' in value:
+            return None
+        # Sums and averages of integer columns come back as DECIMAL strings.
+        v = list(value.values())[0]
+        if type_ == 'int' or type_ is int:
+            return int(Decimal(str(v)))
+        if type_ == 'float' or type_ is float:
+            return float(v)
+        return v
+
+    @staticmethod
+    def _check_fields(entity: Type[ff.Entity], names: List[str]):
+        fields_ = [f.name for f in fields(entity)]
+        for name in names:
+            if name not in fields_:
+                raise ff.InvalidArgument(f"'{entity.__name__}' has no field '{name}'")
+
+    @abstractmethod
+    def _generate_projection_list(self, entity: Type[ff.Entity], fields_: List[str]):
+        pass
+
+    @abstractmethod
+    def _build_projection(self, entity: Type[ff.Entity], fields_: List[str], data: list):
+        pass
 
     def _find(self, uuid: str, entity_type: Type[ff.Entity]):
-        sql = f"select {self._generate_select_list(entity_type)} from {self._fqtn(entity_type)} where id = :id"
+        sql = self._statement((entity_type, 'find'), lambda: (
+            f"select {self._generate_select_list(entity_type)} from {self._fqtn(entity_type)} where id = :id"
+        ))
         params = [{'name': 'id', 'value': {'stringValue': uuid}}]
         result = ff.retry(
             lambda: self._exec(sql, params),
@@ -72,25 +319,204 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
 
         return self._build_entity(entity_type, result['records'][0])
 
+    def find_many(self, entity_type: Type[ff.Entity], ids: List[str]):
+        """
+        Load many entities by id with chunked `in` queries, sized like pages but never binding more than
+        _id_list_limit ids. Returns a dict keyed by id in the order the ids were given; duplicates are loaded once and
+        ids that do not exist are left out.
+        """
+        self._check_prerequisites(entity_type)
+        return self._find_many(entity_type, ids)
+
+    def _find_many(self, entity_type: Type[ff.Entity], ids: List[str]):
+        ids = list(dict.fromkeys(ids))
+        limit = min(self._get_select_limit(entity_type), self._id_list_limit)
+        chunks = [ids[i:i + limit] for i in range(0, len(ids), limit)]
+
+        found = {}
+        with self._executor(min(self._page_concurrency, len(chunks))) as executor:
+            for entities in executor.map(lambda chunk: self._load_ids(entity_type, chunk), chunks):
+                found.update(entities)
+        return {id_: found[id_] for id_ in ids if id_ in found}
+
+    def _load_ids(self, entity: Type[ff.Entity], ids: list):
+        pk = self._primary_key(entity)
+        size, placeholders, params = self._id_list(ids)
+        sql = self._statement((entity, 'find_many', size), lambda: (
+            f"select {self._generate_select_list(entity)},`{pk}` from {self._fqtn(entity)} "
+            f"where `{pk}` in ({placeholders})"
+        ))
+        try:
+            records = self._load_query_results(sql, params)
+            self._observe_page(entity, records)
+            return dict(zip([row[-1]['stringValue'] for row in records], self._build_page(entity, records)))
+        except ClientError as e:
+            if 'Database returned more than the allowed response size limit' not in str(e):
+                raise e
+            self._observe_overflow(entity, len(ids))
+            if len(ids) == 1:
+                return {e.id_value(): e for e in self._load_oversized_page(entity, ids)}
+
+            mid = floor(len(ids) / 2)
+            ret = self._load_ids(entity, ids[:mid])
+            ret.update(self._load_ids(entity, ids[mid:]))
+            return ret
+
     def _remove(self, entity: ff.Entity):
-        sql = f"delete from {self._fqtn(entity.__class__)} where id = :id"
+        t = entity.__class__
+        if self._defer(t, 'remove', entity):
+            return
+        sql = self._statement((t, 'remove'), lambda: (
+            f"delete from {self._fqtn(t)} where `{self._primary_key(t)}` = :id"
+        ))
         params = [
             {'name': 'id', 'value': {'stringValue': entity.id_value()}},
         ]
-        ff.retry(self._exec(sql, params))
+        ff.retry(lambda: self._exec(sql, params))
+
+    def remove_many(self, entities: List[ff.Entity], force: bool = False):
+        """
+        Like remove(), entities with a deleted_on field are soft-deleted unless force is set.
+        """
+        if not force:
+            soft = [e for e in entities if hasattr(e, 'deleted_on')]
+            now = datetime.now()
+            for entity in soft:
+                entity.deleted_on = now
+            self._update_many(soft)
+            entities = [e for e in entities if not hasattr(e, 'deleted_on')]
+
+        for entity_type, group in self._group_by_type(entities).items():
+            self._check_prerequisites(entity_type)
+            if not self._defer(entity_type, 'remove', *group):
+                self._remove_ids(entity_type, [e.id_value() for e in group])
+
+    def remove_where(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp):
+        """
+        Delete every row matching the criteria. Returns the number of rows deleted, or None when the delete is queued
+        in a Data API unit of work.
+        """
+        if criteria is None:
+            raise ff.InvalidArgument('remove_where requires criteria')
+        self._check_prerequisites(entity_type)
+        if self._defer(entity_type, 'remove_where', criteria):
+            return None
+        return self._remove_where(entity_type, criteria)
+
+    def _remove_ids(self, entity_type: Type[ff.Entity], ids: list):
+        count = 0
+        for i in range(0, len(ids), self._delete_batch_size):
+            chunk = ids[i:i + self._delete_batch_size]
+            size, placeholders, params = self._id_list(chunk)
+            sql = self._statement((entity_type, 'remove_ids', size), lambda: (
+                f"delete from {self._fqtn(entity_type)} where `{self._primary_key(entity_type)}` in ({placeholders})"
+            ))
+            count += ff.retry(lambda: self._exec(sql, params))['numberOfRecordsUpdated']
+        return count
+
+    def _remove_where(self, entity_type: Type[ff.Entity], criteria: ff.BinaryOp):
+        clause, params = self._generate_where_clause(criteria)
+        sql = self._statement((entity_type, 'remove_where', clause), lambda: (
+            f"delete from {self._fqtn(entity_type)} {clause}"
+        ))
+        return ff.retry(lambda: self._exec(sql, params))['numberOfRecordsUpdated']
 
     def _update(self, entity: ff.Entity):
+        if self._defer(entity.__class__, 'update', *self._prepare_writes([entity], self._generate_update)):
+            return
         sql, params = self._generate_update(entity)
         ff.retry(lambda: self._exec(sql, params))
 
+    def add_many(self, entities: List[ff.Entity]):
+        for entity_type, group in self._group_by_type(entities).items():
+            self._check_prerequisites(entity_type)
+            writes = self._prepare_writes(group, self._generate_insert)
+            if not self._defer(entity_type, 'add', *writes):
+                self._batch_write(writes)
+
+    def update_many(self, entities: List[ff.Entity]):
+        now = datetime.now()
+        for entity in entities:
+            if hasattr(entity, 'updated_on'):
+                entity.updated_on = now
+        self._update_many(entities)
+
+    def _update_many(self, entities: List[ff.Entity]):
+        for entity_type, group in self._group_by_type(entities).items():
+            self._check_prerequisites(entity_type)
+            writes = self._prepare_writes(group, self._generate_update)
+            if not self._defer(entity_type, 'update', *writes):
+                self._batch_write(writes, update=True)
+
+    @staticmethod
+    def _group_by_type(entities: List[ff.Entity]):
+        ret = {}
+        for entity in entities:
+            ret.setdefault(entity.__class__, []).append(entity)
+        return ret
+
+    def _prepare_writes(self, entities: List[ff.Entity], generate):
+        """
+        (entity, sql, params) for each entity, generated now so that a queued write keeps the entity's current
+        state. sql and params are None for documents too large for a single statement.
+        """
+        ret = []
+        for entity in entities:
+            try:
+                sql, params = generate(entity)
+            except domain.DocumentTooLarge:
+                sql, params = None, None
+            ret.append((entity, sql, params))
+        return ret
+
+    def _batch_write(self, writes: list, update: bool = False):
+        """
+        Run writes from _prepare_writes with batch_execute_statement, splitting the parameter sets so each request
+        stays under _batch_size_limit. Documents that are too large for a single statement are written on their own.
+        """
+        sql = None
+        batch = []
+        batch_size = 0
+        for entity, statement, params in writes:
+            if statement is None:
+                self._insert_large_document(entity, update=update)
+                continue
+
+            size = self._parameter_size(params)
+            if len(batch) > 0 and (statement != sql or (batch_size + size) / 1024 >= self._batch_size_limit):
+                self._exec_batch(sql, batch)
+                batch = []
+                batch_size = 0
+            sql = statement
+            batch.append(params)
+            batch_size += size
+
+        if len(batch) > 0:
+            self._exec_batch(sql, batch)
+
+    @staticmethod
+    def _parameter_size(params: list):
+        """
+        Size of a parameter set in the request body, including the JSON escaping of the values and the name/value
+        envelope around each of them.
+        """
+        return len(json.dumps(params, default=str))
+
+    def _insert_large_document(self, entity: ff.Entity, update: bool = False):
+        raise domain.DocumentTooLarge()
+
     def _generate_insert(self, entity: ff.Entity, part: str = None):
         t = entity.__class__
-        sql = f"insert into {self._fqtn(t)} ({self._generate_column_list(t)}) values ({self._generate_value_list(t)})"
+        sql = self._statement((t, 'insert'), lambda: (
+            f"insert into {self._fqtn(t)} ({self._generate_column_list(t)}) values ({self._generate_value_list(t)})"
+        ))
         return sql, self._generate_parameters(entity, part=part)
 
     def _generate_update(self, entity: ff.Entity, part: str = None):
         t = entity.__class__
-        sql = f"update {self._fqtn(t)} set {self._generate_update_list(t)} where id = :id"
+        sql = self._statement((t, 'update'), lambda: (
+            f"update {self._fqtn(t)} set {self._generate_update_list(t)} where id = :id"
+        ))
         return sql, self._generate_parameters(entity, part=part)
 
     def _get_indexes(self, entity: Type[ff.Entity]):
@@ -103,32 +529,69 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
         return self._cache['indexes'][entity]
 
     def _add_index_params(self, entity: ff.Entity, params: list):
-        for field_ in self._get_indexes(entity.__class__):
-            params.append(self._generate_param_entry(field_.name, field_.type, getattr(entity, field_.name)))
+        for name, encode in self._get_parameter_encoders(entity.__class__):
+            params.append(encode(getattr(entity, name)))
         return params
 
-    @staticmethod
-    def _generate_param_entry(name: str, type_: str, val: any):
-        t = 'stringValue'
-        th = None
+    def _get_parameter_encoders(self, entity: Type[ff.Entity]):
+        """
+        (field name, encoder) pairs for the fields written as statement parameters, compiled once per entity.
+        """
+        encoders = self._cache['parts'].setdefault('encoders', {})
+        if entity not in encoders:
+            encoders[entity] = [
+                (field_.name, self._compile_param_encoder(field_.name, field_.type))
+                for field_ in self._get_parameter_fields(entity)
+            ]
+        return encoders[entity]
+
+    def _get_parameter_fields(self, entity: Type[ff.Entity]):
+        return self._get_indexes(entity)
+
+    @classmethod
+    def _compile_param_encoder(cls, name: str, type_: str):
+        t, th = cls._param_type(type_)
+        null = {'name': name, 'value': {'isNull': True}}
+
+        if th is not None:
+            def encode(val: any):
+                if val is None:
+                    return null.copy()
+                return {'name': name, 'value': {t: str(val).replace('T', ' ')}, 'typeHint': th}
+        else:
+            def encode(val: any):
+                if val is None:
+                    return null.copy()
+                return {'name': name, 'value': {t: val}}
+
+        return encode
+
+    @classmethod
+    def _generate_param_entry(cls, name: str, type_: str, val: any):
         if val is None:
-            t = 'isNull'
-            val = True
-        elif type_ == 'float' or type_ is float:
-            t = 'doubleValue'
+            return {'name': name, 'value': {'isNull': True}}
+
+        t, th = cls._param_type(type_)
+        if th is not None:
+            return {'name': name, 'value': {t: str(val).replace('T', ' ')}, 'typeHint': th}
+        return {'name': name, 'value': {t: val}}
+
+    @staticmethod
+    def _param_type(type_: str):
+        """
+        Data API value key and type hint for a field type.
+        """
+        if type_ == 'float' or type_ is float:
+            return 'doubleValue', None
         elif type_ == 'int' or type_ is int:
-            t = 'longValue'
+            return 'longValue', None
         elif type_ == 'bool' or type_ is bool:
-            t = 'booleanValue'
+            return 'booleanValue', None
         elif type_ == 'bytes' or type_ is bytes:
-            t = 'blobValue'
+            return 'blobValue', None
         elif type_ == 'datetime' or type_ is datetime:
-            val = str(val).replace('T', ' ')
-            th = 'TIMESTAMP'
-        ret = {'name': name, 'value': {t: val}}
-        if th is not None:
-            ret['typeHint'] = th
-        return ret
+            return 'stringValue', 'TIMESTAMP'
+        return 'stringValue', None
 
     def _generate_index(self, name: str):
         return f'INDEX idx_{name} (`{name}`)'
@@ -143,11 +606,61 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
         if criteria is None:
             return '', []
 
-        clause, params = criteria.to_sql()
-        ret = []
-        for k, v in params.items():
-            ret.append(self._generate_param_entry(k, type(v), v))
-        return f'where {clause}', ret
+        params = []
+        return f'where {self._criteria_sql(criteria, params)}', params
+
+    def _criteria_sql(self, bop: ff.BinaryOp, params: list):
+        """
+        Written out here rather than with BinaryOp.to_sql, whose handling of attributes with function calls differs
+        between firefly versions, so that attributes can also be replaced by SqlExpressions.
+        """
+        lhv = self._operand_sql(bop.lhv, params)
+        if bop.op in ('is', 'is not') and (bop.rhv is None or bop.rhv == 'null'):
+            return f'({lhv} {bop.op} null)'
+        if bop.op in ('is', 'is not') and isinstance(bop.rhv, bool):
+            return f'({lhv} {bop.op} {str(bop.rhv).lower()})'
+
+        rhv = self._operand_sql(bop.rhv, params)
+        if bop.op == 'startswith':
+            return f"({lhv} like CONCAT({rhv}, '%'))"
+        if bop.op == 'endswith':
+            return f"({lhv} like CONCAT('%', {rhv}))"
+        return f'({lhv} {bop.op.replace("==", "=")} {rhv})'
+
+    def _operand_sql(self, value, params: list):
+        if isinstance(value, ff.BinaryOp):
+            return self._criteria_sql(value, params)
+        if isinstance(value, SqlExpression):
+            return value.sql
+        if isinstance(value, (ff.Attr, ff.AttributeString)):
+            name, functions = self._attribute(value)
+            return self._apply_functions(f'`{name}`', functions)
+        if isinstance(value, (list, tuple, set)):
+            if len(value) == 0:
+                return '(null)'
+            return f"({','.join(self._operand_sql(v, params) for v in value)})"
+
+        name = f'var{len(params) + 1}'
+        params.append(self._generate_param_entry(name, type(value), value))
+        return f':{name}'
+
+    @staticmethod
+    def _attribute(attr):
+        """
+        Field name and function calls (outermost first) of a criteria attribute such as LOWER(name).
+        """
+        if isinstance(attr, ff.Attr):
+            attr = attr.attr
+        if hasattr(attr, 'get_modifiers'):
+            return str(attr), list(attr.get_modifiers() or [])
+        text = str(attr)
+        return ff.BinaryOp._remove_function_calls(text), re.findall(r'(\w+)\(', text)
+
+    @staticmethod
+    def _apply_functions(sql: str, functions: list):
+        for function in reversed(functions):
+            sql = f'{function}({sql})'
+        return sql
 
     def _execute_ddl(self, entity: Type[ffd.Entity]):
         self._exec(f"create database if not exists {entity.get_class_context()}", [])
@@ -165,6 +678,9 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
             if index not in table_indexes:
                 self._add_table_index(entity, list(filter(lambda f: f.name == index, indexes))[0])
 
+        if self._persistent_metadata():
+            self._get_table_metadata(entity, refresh=True)
+
     @abstractmethod
     def _get_table_indexes(self, entity: Type[ffd.Entity]):
         pass
@@ -182,38 +698,380 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
         result = ff.retry(lambda: self._exec(count_sql, params))
         return result['records'][0][0]['longValue']
 
-    def _paginate(self, sql: str, params: list, entity: Type[ff.Entity]):
-        if entity.__name__ not in self._select_limits:
-            self._select_limits[entity.__name__] = self._get_average_row_size(entity)
-        limit = floor(self._size_limit / self._select_limits[entity.__name__])
-        offset = 0
+    def _paginate(self, entity: Type[ff.Entity], criteria: ff.BinaryOp = None, raw: bool = False,
+                  stream: bool = False, max_rows: int = None, projection: List[str] = None):
+        """
+        Load the results of a query one page at a time.
 
-        ret = []
+        Pages are read with keyset (seek) pagination: rows are ordered by the key columns from _get_keyset_columns
+        and each page starts after the last key of the previous one, so every page costs the same no matter how deep
+        into the table it is. When the first page comes back full and _page_concurrency is above 1, the remaining
+        keys are scanned up front and the resulting key ranges are loaded in parallel. Inside a transaction pages are
+        read one at a time on the calling thread.
+
+        With stream=True a generator is returned instead of a list. Only the pages being consumed or fetched are held
+        in memory. With a projection only those fields are selected, and rows come back from _build_projection.
+        """
+        entities = itertools.chain.from_iterable(self._fetch_pages(entity, criteria, raw, max_rows, projection))
+        if stream:
+            return entities
+        return list(entities)
+
+    def _fetch_pages(self, entity: Type[ff.Entity], criteria: ff.BinaryOp = None, raw: bool = False,
+                     max_rows: int = None, projection: List[str] = None):
+        keys = self._get_keyset_columns(entity, criteria)
+        key_list = ','.join(map(lambda k: f'`{k}`', keys))
+        clause, params = self._generate_where_clause(criteria)
+        shape = tuple(keys)
+        if projection is not None:
+            sql = self._statement((entity, 'project', shape, tuple(projection)), lambda: (
+                f"select {self._generate_projection_list(entity, projection)},{key_list} from {self._fqtn(entity)}"
+            ))
+        else:
+            sql = self._statement((entity, 'page', shape), lambda: (
+                f"select {self._generate_select_list(entity)},{key_list} from {self._fqtn(entity)}"
+            ))
+        key_sql = self._statement((entity, 'keys', shape), lambda: f"select {key_list} from {self._fqtn(entity)}")
+        fetched = 0
+
+        def submit(executor_, cursor_):
+            limit_ = self._get_select_limit(entity)
+            if max_rows is not None:
+                limit_ = min(limit_, max_rows - fetched)
+            return executor_.submit(self._read_page, entity, sql, key_sql, clause, params, keys, cursor_, limit_)
+
+        with self._executor(1) as executor:
+            future = submit(executor, None)
+            while future is not None:
+                records, ids, cursor, count, limit = future.result()
+                future = None
+
+                fetched += count
+                more = count == limit and (max_rows is None or fetched < max_rows)
+                if more and self._concurrency() <= 1:
+                    future = submit(executor, cursor)
+
+                if count > 0:
+                    yield self._build_page(entity, records, ids, raw, projection)
+                if more and self._concurrency() > 1:
+                    remaining = None if max_rows is None else max_rows - fetched
+                    yield from self._fetch_ranges(
+                        entity, sql, key_sql, clause, params, keys, cursor, raw, remaining, projection
+                    )
+
+    def _read_page(self, entity: Type[ff.Entity], sql: str, key_sql: str, clause: str, params: list, keys: list,
+                   cursor: list, limit: int):
+        records, limit = self._load_page(entity, *self._keyset_query(sql, clause, params, keys, cursor), limit)
+        if records is not None:
+            if len(records) > 0:
+                cursor = records[-1][-len(keys):]
+            return records, None, cursor, len(records), limit
+
+        key_records = self._load_query_results(*self._keyset_query(key_sql, clause, params, keys, cursor), limit)
+        if len(key_records) > 0:
+            cursor = key_records[-1]
+        return None, [row[-1]['stringValue'] for row in key_records], cursor, len(key_records), limit
+
+    def _build_page(self, entity: Type[ff.Entity], records: list = None, ids: list = None, raw: bool = False,
+                    projection: List[str] = None):
+        if records is None:
+            if projection is not None:
+                return self._load_oversized_projection(entity, ids, projection)
+            return self._load_oversized_page(entity, ids, raw)
+        if projection is not None:
+            return [self._build_projection(entity, projection, row) for row in records]
+        return [self._build_entity(entity, row, raw=raw) for row in records]
+
+    def _fetch_ranges(self, entity: Type[ff.Entity], sql: str, key_sql: str, clause: str, params: list, keys: list,
+                      cursor: list, raw: bool = False, max_rows: int = None, projection: List[str] = None):
+        """
+        Scan the keys after the cursor, cut them into ranges of one page each and load those ranges on a thread pool.
+        Pages are yielded in key order, and no more than twice _page_concurrency ranges are in flight at a time.
+        """
+        fetched = 0
+        pending = deque()
+        with self._executor(self._page_concurrency) as executor:
+            while max_rows is None or fetched < max_rows:
+                key_records, scan = self._scan_keys(
+                    entity, key_sql, clause, params, keys, cursor, None if max_rows is None else max_rows - fetched
+                )
+                limit = self._get_select_limit(entity)
+                for i in range(0, len(key_records), limit):
+                    chunk = key_records[i:i + limit]
+                    pending.append(executor.submit(
+                        self._load_range, entity, sql, clause, params, keys, cursor, chunk, raw, projection
+                    ))
+                    cursor = chunk[-1]
+                    while len(pending) >= self._page_concurrency * 2:
+                        yield pending.popleft().result()
+
+                fetched += len(key_records)
+                if len(key_records) < scan:
+                    break
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+    def _scan_keys(self, entity: Type[ff.Entity], key_sql: str, clause: str, params: list, keys: list, cursor: list,
+                   max_rows: int = None):
+        """
+        Read the next keys after the cursor, at most _key_scan_size of them. The number read at once is sized from the
+        width of the keys already seen, so wide keys such as long varchar columns stay under the response size limit,
+        and is halved when a response goes over it anyway. Returns the key records and the number asked for.
+        """
+        name = entity.__name__
         while True:
+            scan = self._key_scan_limits.get(name, self._key_scan_size)
+            if max_rows is not None:
+                scan = min(scan, max_rows)
             try:
-                result = ff.retry(
-                    lambda: self._exec(f'{sql} limit {limit} offset {offset}', params),
-                    should_retry=lambda err: 'Database returned more than the allowed response size limit' not in str(err)
-                )
+                records = self._load_query_results(*self._keyset_query(key_sql, clause, params, keys, cursor), scan)
             except ClientError as e:
-                if 'Database returned more than the allowed response size limit' in str(e) and limit > 10:
-                    limit = floor(limit / 2)
-                    self._select_limits[entity.__name__] = limit
-                    continue
+                if 'Database returned more than the allowed response size limit' not in str(e) or scan <= 1:
+                    raise e
+                self._key_scan_limits[name] = max(floor(scan / 2), 1)
+                continue
+
+            if len(records) > 0:
+                width = max(self._response_size(records) / len(records), 1)
+                self._key_scan_limits[name] = max(
+                    min(floor(self._size_limit * 1024 * self._page_fill / width), self._key_scan_size), 1
+                )
+            return records, scan
+
+    def _load_range(self, entity: Type[ff.Entity], sql: str, clause: str, params: list, keys: list, lower: list,
+                    key_records: list, raw: bool = False, projection: List[str] = None):
+        try:
+            records = self._load_query_results(
+                *self._keyset_query(sql, clause, params, keys, lower, key_records[-1])
+            )
+            self._observe_page(entity, records)
+            return self._build_page(entity, records, raw=raw, projection=projection)
+        except ClientError as e:
+            if 'Database returned more than the allowed response size limit' not in str(e):
                 raise e
+            self._observe_overflow(entity, len(key_records))
+            if len(key_records) == 1:
+                return self._build_page(entity, ids=[key_records[0][-1]['stringValue']], raw=raw,
+                                        projection=projection)
+
+            mid = floor(len(key_records) / 2)
+            return self._load_range(entity, sql, clause, params, keys, lower, key_records[:mid], raw, projection) + \
+                self._load_range(entity, sql, clause, params, keys, key_records[mid - 1], key_records[mid:], raw,
+                                 projection)
+
+    def _get_keyset_columns(self, entity: Type[ff.Entity], criteria: ff.BinaryOp = None):
+        """
+        Columns to order and seek on. The primary key is always the last column so the ordering is total. If the
+        criteria puts a range on an indexed column we page on that column first, which lets MySQL walk the index.
+        """
+        pk = self._primary_key(entity)
+        indexes = [f.name for f in self.get_indexes(entity)]
+        for bop in self._conjuncts(criteria):
+            if bop.op not in ('>', '>=', '<', '<=') or not isinstance(bop.lhv, (ff.Attr, ff.AttributeString)):
+                continue
+            name, functions = self._attribute(bop.lhv)
+            if name in indexes and name != pk and len(functions) == 0:
+                return [name, pk]
+        return [pk]
+
+    def _conjuncts(self, criteria: ff.BinaryOp = None):
+        if criteria is None:
+            return []
+        if criteria.op == 'and':
+            ret = []
+            for side in (criteria.lhv, criteria.rhv):
+                if isinstance(side, ff.BinaryOp):
+                    ret.extend(self._conjuncts(side))
+            return ret
+        return [criteria]
+
+    def _keyset_query(self, sql: str, clause: str, params: list, keys: list, cursor: list = None, end: list = None):
+        def seek(name: str, op: str, last_op: str):
+            ret = f'`{keys[-1]}` {last_op} :{name}{len(keys) - 1}'
+            for i in reversed(range(len(keys) - 1)):
+                ret = f'(`{keys[i]}` {op} :{name}{i} or (`{keys[i]}` = :{name}{i} and {ret}))'
+            return ret
+
+        def build():
+            conditions = []
+            if cursor is not None:
+                conditions.append(seek('keyset', '>', '>'))
+            if end is not None:
+                conditions.append(seek('keysetend', '<', '<='))
+
+            where = clause
+            if len(conditions) > 0:
+                conditions = ' and '.join(conditions)
+                where = f'{clause} and {conditions}' if clause else f'where {conditions}'
 
-            for row in result['records']:
-                obj = self._serializer.deserialize(row[0]['stringValue'])
-                ret.append(entity.from_dict(obj))
-            if len(result['records']) < limit:
-                break
-            offset += limit
+            order_by = ','.join(map(lambda k: f'`{k}`', keys))
+            return f'{sql} {where} order by {order_by}'
 
+        if cursor is not None:
+            params = params + [{'name': f'keyset{i}', 'value': v} for i, v in enumerate(cursor)]
+        if end is not None:
+            params = params + [{'name': f'keysetend{i}', 'value': v} for i, v in enumerate(end)]
+
+        return self._statement(('keyset', sql, clause, tuple(keys), cursor is not None, end is not None), build), params
+
+    def _statement(self, key: tuple, build):
+        """
+        SQL text for one statement shape, built on first use and reused afterwards. The key holds the entity type and
+        the operation, plus whatever changes the text, such as the number of placeholders or the where clause
+        produced by _generate_where_clause. Pages are loaded on several threads, so eviction and inserts share a lock.
+        """
+        statements = self._cache.setdefault('statements', {})
+        ret = statements.get(key)
+        if ret is None:
+            ret = build()
+            with self._statement_lock:
+                if key not in statements and len(statements) >= self._statement_cache_size:
+                    statements.pop(next(iter(statements)))
+                statements[key] = ret
         return ret
 
-    def _load_query_results(self, sql: str, params: list, limit: int, offset: int):
+    @staticmethod
+    def _id_list(ids: list):
+        """
+        Placeholders and parameters for an `in` list of ids. The list is padded to the next power of two by repeating
+        the last id, so statements are cached per bucket of sizes rather than per id count.
+        """
+        size = 1 << (len(ids) - 1).bit_length()
+        padded = ids + ids[-1:] * (size - len(ids))
+        placeholders = ','.join(map(lambda n: f':id{n}', range(size)))
+        return size, placeholders, [{'name': f'id{n}', 'value': {'stringValue': id_}} for n, id_ in enumerate(padded)]
+
+    def _primary_key(self, entity: Type[ff.Entity]):
+        return 'id'
+
+    def _load_page(self, entity: Type[ff.Entity], sql: str, params: list, limit: int):
+        while True:
+            try:
+                records = self._load_query_results(sql, params, limit)
+                self._observe_page(entity, records)
+                return records, limit
+            except ClientError as e:
+                if 'Database returned more than the allowed response size limit' not in str(e):
+                    raise e
+                self._observe_overflow(entity, limit)
+                if limit <= 10:
+                    return None, limit
+                limit = min(floor(limit / 2), self._get_select_limit(entity))
+
+    def _get_select_limit(self, entity: Type[ff.Entity]):
+        """
+        Current page limit for an entity type. It starts from the table's average row size and is then steered by
+        _observe_page and _observe_overflow towards pages of _page_fill * _size_limit.
+        """
+        name = entity.__name__
+        if name not in self._select_limits:
+            if name not in self._row_sizes:
+                self._row_sizes[name] = max(self._get_table_metadata(entity)['average_row_size'], 0.001)
+            self._select_limits[name] = self._target_limit(name)
+        return self._select_limits[name]
+
+    def _target_limit(self, name: str):
+        return max(floor(self._size_limit * self._page_fill / self._row_sizes[name]), 1)
+
+    def _observe_page(self, entity: Type[ff.Entity], records: list):
+        if len(records) == 0:
+            return
+
+        name = entity.__name__
+        observed = max(self._response_size(records) / 1024 / len(records), 0.001)
+        self._row_sizes[name] = (self._row_sizes.get(name, observed) + observed) / 2
+        current = self._select_limits.get(name, len(records))
+        self._select_limits[name] = min(self._target_limit(name), current * 2)
+
+    def _observe_overflow(self, entity: Type[ff.Entity], limit: int):
+        name = entity.__name__
+        self._row_sizes[name] = max(self._row_sizes.get(name, 0), self._size_limit / max(limit, 1))
+        self._select_limits[name] = max(min(self._select_limits.get(name, limit), floor(limit / 2)), 1)
+
+    @staticmethod
+    def _response_size(records: list):
+        size = 0
+        for row in records:
+            for cell in row:
+                for v in cell.values():
+                    size += len(v) if isinstance(v, (str, bytes)) else 8
+                size += 20  # Per-value JSON overhead in the Data API response
+        return size
+
+    def _get_table_metadata(self, entity: Type[ff.Entity], refresh: bool = False):
+        """
+        Table statistics used to size pages. When an S3 bucket is available they are cached there for
+        _metadata_ttl seconds, and refreshed whenever DDL is executed, so a cold start does not have to rescan the
+        table.
+        """
+        persistent = self._persistent_metadata()
+        if persistent and not refresh:
+            metadata = self._load_table_metadata(entity)
+            if metadata is not None and time() - metadata['updated_at'] < self._metadata_ttl:
+                return metadata
+
+        metadata = {
+            'average_row_size': self._get_average_row_size(entity),
+            'updated_at': time(),
+        }
+        if persistent:
+            self._store_table_metadata(entity, metadata)
+        return metadata
+
+    def _persistent_metadata(self):
+        return self._s3_client is not None and self._bucket is not None
+
+    def _load_table_metadata(self, entity: Type[ff.Entity]):
+        try:
+            response = self._s3_client.get_object(Bucket=self._bucket, Key=self._metadata_key(entity))
+            return self._serializer.deserialize(response['Body'].read())
+        except ClientError as e:
+            if 'NoSuchKey' not in str(e):
+                self.info('Could not load table metadata for %s: %s', entity.__name__, str(e))
+            return None
+
+    def _store_table_metadata(self, entity: Type[ff.Entity], metadata: dict):
+        try:
+            self._s3_client.put_object(
+                Bucket=self._bucket,
+                Key=self._metadata_key(entity),
+                Body=self._serializer.serialize(metadata)
+            )
+        except ClientError as e:
+            self.info('Could not store table metadata for %s: %s', entity.__name__, str(e))
+
+    def _metadata_key(self, entity: Type[ff.Entity]):
+        return f'data-api/metadata/{self._fqtn(entity)}.json'
+
+    def _load_oversized_page(self, entity: Type[ff.Entity], ids: list, raw: bool = False):
+        """
+        Called when a page cannot be loaded even at the minimum page size. The rows are loaded by id in ever smaller
+        groups; a single row that does not fit in a response is an error. Interfaces that know how to fetch documents
+        in pieces should override this.
+        """
+        if len(ids) == 1:
+            raise ff.RepositoryError(f'Could not load {ids[0]}: response size limit exceeded')
+
+        entities = self._load_ids(entity, ids)
+        if raw:
+            return [entities[id_].to_dict() for id_ in ids if id_ in entities]
+        return [entities[id_] for id_ in ids if id_ in entities]
+
+    def _load_oversized_projection(self, entity: Type[ff.Entity], ids: list, projection: List[str]):
+        ret = []
+        sql = f"select {self._generate_projection_list(entity, projection)} from {self._fqtn(entity)} " \
+              f"where `{self._primary_key(entity)}` = :id"
+        for id_ in ids:
+            records = self._load_query_results(sql, [{'name': 'id', 'value': {'stringValue': id_}}])
+            ret.extend([self._build_projection(entity, projection, row) for row in records])
+        return ret
+
+    def _load_query_results(self, sql: str, params: list, limit: int = None):
+        if limit is not None:
+            sql = f'{sql} limit {limit}'
         return ff.retry(
-            lambda: self._exec(f'{sql} limit {limit} offset {offset}', params),
+            lambda: self._exec(sql, params),
             should_retry=lambda err: 'Database returned more than the allowed response size limit'
                                      not in str(err)
         )['records']
@@ -228,13 +1086,66 @@ class DataApiStorageInterface(ffi.RdbStorageInterface, ABC):
         """
         pass
 
+    def _exec_batch(self, sql: str, param_sets: List[list]):
+        self.debug(sql)
+        self.debug('%d parameter sets', len(param_sets))
+        return ff.retry(lambda: self._measure(sql, lambda: self._rds_data_client.batch_execute_statement(
+            sql=sql,
+            parameterSets=param_sets,
+            **self._statement_args()
+        )))
+
     def _exec(self, sql: str, params: list):
         self.debug(sql)
         self.debug(params)
-        return self._rds_data_client.execute_statement(
-            resourceArn=self._db_arn,
-            secretArn=self._db_secret_arn,
-            database=self._db_name,
+        return self._measure(sql, lambda: self._rds_data_client.execute_statement(
             sql=sql,
-            parameters=params
-        )
+            parameters=params,
+            **self._statement_args()
+        ))
+
+    def _measure(self, sql: str, call):
+        if self._data_api_instrumentation is None:
+            return call()
+
+        start = perf_counter()
+        try:
+            result = call()
+        except ClientError as e:
+            self._data_api_instrumentation.record_error(
+                sql,
+                perf_counter() - start,
+                size_limit='Database returned more than the allowed response size limit' in str(e)
+            )
+            raise e
+
+        latency = perf_counter() - start
+        if 'records' in result:
+            rows = len(result['records'])
+            bytes_ = self._response_size(result['records'])
+        else:
+            rows = result.get('numberOfRecordsUpdated', len(result.get('updateResults', [])))
+            bytes_ = 0
+        self._data_api_instrumentation.record(sql, latency, rows=rows, bytes_=bytes_)
+        return result
+
+    def _concurrency(self):
+        return 1 if self._transaction_id is not None else self._page_concurrency
+
+    def _executor(self, max_workers: int):
+        """
+        Thread pool for concurrent statements, or a serial stand-in while a transaction is open.
+        """
+        if self._transaction_id is not None:
+            return _SerialExecutor()
+        return ThreadPoolExecutor(max_workers=max(max_workers, 1))
+
+    def _statement_args(self):
+        ret = {
+            'resourceArn': self._db_arn,
+            'secretArn': self._db_secret_arn,
+            'database': self._db_name,
+        }
+        if self._transaction_id is not None:
+            ret['transactionId'] = self._transaction_id
+        return ret
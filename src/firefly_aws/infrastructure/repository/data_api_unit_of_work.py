@@ -0,0 +1,59 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+from typing import List
+
+import firefly as ff
+
+
+class DataApiUnitOfWork(ff.LoggerAware):
+    """
+    Collects the writes Data API storage interfaces receive while the repositories are committed, so they can be
+    flushed together in one transaction per interface before the message's events are dispatched.
+    """
+
+    def __init__(self):
+        self._active = False
+        self._interfaces: List = []
+
+    def is_active(self):
+        return self._active
+
+    def begin(self):
+        self._active = True
+        self._interfaces = []
+
+    def enlist(self, interface):
+        if interface not in self._interfaces:
+            self._interfaces.append(interface)
+
+    def commit(self):
+        self._active = False
+        interfaces, self._interfaces = self._interfaces, []
+        for i, interface in enumerate(interfaces):
+            self.debug('Flushing %s', interface)
+            try:
+                interface.flush()
+            except Exception as e:
+                for remaining in interfaces[i + 1:]:
+                    remaining.discard()
+                raise e
+
+    def rollback(self):
+        self._active = False
+        interfaces, self._interfaces = self._interfaces, []
+        for interface in interfaces:
+            interface.discard()
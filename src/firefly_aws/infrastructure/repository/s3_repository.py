@@ -14,73 +14,707 @@
 
 from __future__ import annotations
 
+import hashlib
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import fields
+from datetime import date
+from copy import deepcopy
+from functools import reduce
+from threading import Lock
+from time import time, time_ns
 from typing import List, Callable, Optional, Union
 
 import firefly as ff
 import inflection
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ParamValidationError
 from firefly.domain.repository.repository import T
 
+_ABSENT = object()
+
 
 class S3Repository(ff.Repository[T]):
+    _max_workers: int = 16
+    _list_page_size: int = 1000
+    _index_shards: int = 16  # Every write rewrites one whole shard of each index manifest
+    _index_retries: int = 5
+    _select: bool = False  # Evaluate criteria with S3 Select so only matching objects are transferred
+    _snapshots: bool = False  # Keep a delta log of writes and read full scans from the compacted snapshot
+    _segment_size: int = 64 * 1024  # In KB
+    _range_size: int = 8 * 1024  # In KB
+    _delta_margin: int = 300  # In seconds
+    _cache_size: int = 16 * 1024  # In KB of serialized aggregates, 0 disables the find() cache
+    _cache_ttl: int = 0  # In seconds, cached aggregates younger than this are returned without revalidation
+
     def __init__(self, s3_client, serializer: ff.Serializer, bucket: str, prefix: str = 'object-store/aggregates'):
         self._s3_client = s3_client
         self._serializer = serializer
         self._bucket = bucket
         name = inflection.pluralize(inflection.dasherize(inflection.underscore(self._type().__name__)))
         self._storage_path = f'{prefix}/{name}'.lstrip('/')
+        self._ready_indexes = set()
+        self._conditional_writes = True
+        self._entity_cache = OrderedDict()
+        self._entity_cache_bytes = 0
+        self._entity_cache_lock = Lock()
 
     def add(self, entity: T):
+        written_at = time_ns()
+        self._uncache(self._key(entity.id_value()))
+        # The index manifests are updated before the object is written, and put back if the write fails, so they
+        # always list every stored aggregate.
+        previous = {}
         try:
+            self._update_indexes(entity.id_value(), entity, previous)
             self._s3_client.put_object(
                 Bucket=self._bucket,
-                Key=f'{self._storage_path}/{entity.id_value()}.json',
+                Key=self._key(entity.id_value()),
                 Body=self._serializer.serialize(entity.to_dict()),
             )
         except ClientError as e:
+            self._restore_indexes(entity.id_value(), previous)
             raise ff.RepositoryError(str(e))
+        except ff.RepositoryError:
+            self._restore_indexes(entity.id_value(), previous)
+            raise
+        self._write_delta(written_at, 'put', entity.id_value())
 
     def remove(self, entity: T):
+        written_at = time_ns()
+        self._uncache(self._key(entity.id_value()))
         try:
             self._s3_client.delete_object(
                 Bucket=self._bucket,
-                Key=f'{self._storage_path}/{entity.id_value()}',
+                Key=self._key(entity.id_value()),
             )
         except ClientError as e:
             raise ff.RepositoryError(str(e))
+        # Dropped from the manifests only once the object is gone, for the same reason as in add().
+        self._update_indexes(entity.id_value())
+        self._write_delta(written_at, 'remove', entity.id_value())
 
     def find(self, exp: Union[str, Callable]) -> Optional[T]:
         if isinstance(exp, str):
-            try:
-                response = self._s3_client.get_object(
-                    Bucket=self._bucket,
-                    Key=f'{self._storage_path}/{exp}.json',
-                )
-                data = self._serializer.deserialize(response['Body'].read())
-                return self._type().from_dict(data)
-            except ClientError as e:
-                if 'NoSuchKey' in str(e):
-                    return None
-                raise ff.RepositoryError(str(e))
+            return self._find_by_id(exp)
 
-        # TODO implement search criteria
+        entities = self._query(self._get_search_criteria(exp))
+        try:
+            return next(entities, None)
+        finally:
+            entities.close()
 
-    def filter(self, cb: Callable) -> List[T]:
-        # TODO implement search criteria
-        pass
+    def filter(self, cb: Union[Callable, ff.BinaryOp]) -> List[T]:
+        return list(self._query(self._get_search_criteria(cb)))
 
     def reduce(self, cb: Callable) -> Optional[T]:
-        # TODO implement search criteria
-        pass
+        """
+        Fold cb over every stored aggregate. Aggregates are fetched concurrently and folded in the order they arrive,
+        which is neither key order nor stable between calls, so cb must be commutative and associative (picking the
+        largest or the earliest, for example) for the result to be deterministic.
+        """
+        entities = self._scan()
+        try:
+            first = next(entities, None)
+            if first is None:
+                return None
+            return reduce(cb, entities, first)
+        finally:
+            entities.close()
 
     def __iter__(self):
-        pass
+        return self._scan()
 
     def __next__(self):
         pass
 
     def __len__(self):
-        pass
+        return sum(1 for _ in self._list_keys())
 
     def __getitem__(self, item):
-        pass
+        keys = list(self._list_keys())
+        if isinstance(item, slice):
+            return list(self._stream(keys=keys[item], ordered=True))
+        return self._load(keys[item])
+
+    def rebuild_indexes(self):
+        """
+        Rewrite the index manifests of every indexed field from the stored aggregates. Needed once after index=True
+        is added to a field of an entity that already has aggregates stored, and after a failed write could not put
+        its manifest entries back; until then queries on that field read every object.
+        """
+        manifests = {name: [{} for _ in range(self._index_shards)] for name in self._get_indexes()}
+        for entity in self._scan():
+            for name, shards in manifests.items():
+                shards[self._shard(entity.id_value())][entity.id_value()] = self._index_value(getattr(entity, name))
+
+        for name, shards in manifests.items():
+            for shard, manifest in enumerate(shards):
+                self._put_manifest(self._index_key(name, shard), manifest)
+            self._put_manifest(self._index_key(name, 'ready'), {})
+            self._ready_indexes.add(name)
+
+    def compact(self, rebuild: bool = False):
+        """
+        Pack the repository into newline-delimited snapshot segments of about _segment_size KB under _snapshot/, cut
+        into blocks of about _range_size KB that start and end on record boundaries, so full scans cost one ranged GET
+        per block instead of one GET per aggregate. The manifest lists the blocks, not the records, so its size does
+        not grow with the number of aggregates in a segment. Writes made after the snapshot are picked up from the delta log. Run it periodically with
+        _snapshots enabled.
+
+        The new snapshot is built from the current one plus its deltas, or from every object when rebuild=True or
+        there is no snapshot yet. Segments are kept for one more compaction so that scans which started on the
+        previous snapshot can finish; the same goes for the deltas logged before the previous snapshot.
+        """
+        previous = self._get_snapshot()
+        since = time_ns() - self._delta_margin * 10 ** 9
+        snapshot_id = f'{time_ns():020d}'
+        entities = self._stream() if rebuild or previous is None else self._stream_snapshot(previous)
+
+        segments = []
+        buffer = bytearray()
+        blocks = []
+        for entity in entities:
+            buffer += (self._serializer.serialize(entity.to_dict()) + '\n').encode('utf-8')
+            start = blocks[-1][1] + 1 if len(blocks) > 0 else 0
+            if len(buffer) - start >= self._range_size * 1024:
+                blocks.append([start, len(buffer) - 1])
+            if len(buffer) >= self._segment_size * 1024:
+                segments.append(self._put_segment(snapshot_id, len(segments), buffer, blocks))
+                buffer = bytearray()
+                blocks = []
+        if len(buffer) > 0:
+            segments.append(self._put_segment(snapshot_id, len(segments), buffer, blocks))
+
+        self._put_manifest(self._snapshot_key('manifest'), {
+            'since': since,
+            'segments': segments,
+            'previous': [segment['key'] for segment in previous['segments']] if previous is not None else [],
+        })
+
+        if previous is not None:
+            self._delete(previous['previous'])
+            deltas = self._snapshot_key('deltas/')
+            self._delete(list(self._list(deltas, end_before=f'{deltas}{previous["since"]:020d}')))
+
+    def _query(self, criteria: ff.BinaryOp):
+        expression = self._select_expression(criteria) if self._select and criteria is not None else None
+        ids = self._find_candidates(criteria, {})
+        if ids is None:
+            return self._scan(criteria, expression)
+        return self._stream(criteria, keys=sorted(map(self._key, ids)), expression=expression)
+
+    def _select_expression(self, criteria: ff.BinaryOp) -> Optional[str]:
+        """
+        S3 Select WHERE clause for the criteria, or None when any part of them can only be evaluated in Python.
+        Missing attributes are NULL in S3 Select, so != also accepts NULL to agree with the Python comparison.
+        """
+        if criteria.op in ('and', 'or'):
+            if not isinstance(criteria.lhv, ff.BinaryOp) or not isinstance(criteria.rhv, ff.BinaryOp):
+                return None
+            lhv = self._select_expression(criteria.lhv)
+            rhv = self._select_expression(criteria.rhv)
+            if lhv is None or rhv is None:
+                return None
+            return f'({lhv} {criteria.op.upper()} {rhv})'
+
+        name = self._field_name(criteria.lhv)
+        if name is None:
+            return None
+        column = f's."{name}"'
+        op, value = criteria.op, criteria.rhv
+
+        if (op == 'is' and value in ('null', None)) or (op == '==' and value is None):
+            return f'{column} IS NULL'
+        if op == '!=' and value is None:
+            return f'{column} IS NOT NULL'
+        if op == 'in':
+            if not isinstance(value, (list, tuple, set)) or len(value) == 0:
+                return None
+            values = [self._select_literal(v) for v in value]
+            return None if None in values else f'{column} IN ({", ".join(values)})'
+        if op in ('startswith', 'endswith'):
+            if not isinstance(value, str) or re.search(r'[%_\\]', value):
+                return None
+            pattern = f'{value}%' if op == 'startswith' else f'%{value}'
+            return f'{column} LIKE {self._select_literal(pattern)}'
+
+        literal = self._select_literal(value)
+        if literal is None:
+            return None
+        if op == 'is' and isinstance(value, bool):
+            return f'{column} = {literal}'
+        if op == '!=':
+            return f'({column} <> {literal} OR {column} IS NULL)'
+        if op in ('==', '<', '<=', '>', '>='):
+            return f'{column} {"=" if op == "==" else op} {literal}'
+        return None
+
+    @staticmethod
+    def _select_literal(value) -> Optional[str]:
+        if isinstance(value, bool):
+            return 'TRUE' if value else 'FALSE'
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return None
+
+    def _find_candidates(self, criteria: ff.BinaryOp, manifests: dict):
+        """
+        Ids that can match the criteria according to the index manifests, or None when part of the criteria has to
+        be checked against every object. Candidates are still matched against the full criteria once fetched.
+        """
+        if criteria.op in ('and', 'or'):
+            sides = [
+                self._find_candidates(side, manifests) if isinstance(side, ff.BinaryOp) else None
+                for side in (criteria.lhv, criteria.rhv)
+            ]
+            if criteria.op == 'or':
+                return None if None in sides else sides[0] | sides[1]
+            if sides[0] is None or sides[1] is None:
+                return sides[1] if sides[0] is None else sides[0]
+            return sides[0] & sides[1]
+
+        if isinstance(criteria.rhv, (ff.Attr, ff.AttributeString, ff.BinaryOp)):
+            return None
+        name = self._field_name(criteria.lhv)
+        if name not in self._get_indexes() or not self._index_ready(name):
+            return None
+
+        if name not in manifests:
+            manifests[name] = self._read_index(name)
+        rhv = criteria.rhv
+        if isinstance(rhv, (list, tuple)):
+            rhv = [self._index_value(v) for v in rhv]
+        else:
+            rhv = self._index_value(rhv)
+        leaf = ff.BinaryOp(ff.AttributeString(name), criteria.op, rhv)
+
+        ret = set()
+        for id_, value in manifests[name].items():
+            try:
+                if leaf.matches({name: value}):
+                    ret.add(id_)
+            except TypeError:
+                pass
+        return ret
+
+    @staticmethod
+    def _field_name(attr) -> Optional[str]:
+        """
+        Name of the field a criteria attribute reads, or None when it is not a plain field (e.g. LOWER(name)).
+        Depending on the firefly version, function calls are kept in the attribute's text or in its modifiers.
+        """
+        if isinstance(attr, ff.Attr):
+            attr = attr.attr
+        if not isinstance(attr, ff.AttributeString) or len(getattr(attr, 'get_modifiers', lambda: [])() or []) > 0:
+            return None
+        return str(attr) if re.match(r'^\w+$', str(attr)) else None
+
+    def _get_indexes(self):
+        if not hasattr(self, '_indexes'):
+            self._indexes = [
+                f.name for f in fields(self._type()) if 'index' in f.metadata and f.metadata['index'] is True
+            ]
+        return self._indexes
+
+    def _index_ready(self, name: str):
+        if name not in self._ready_indexes:
+            try:
+                self._s3_client.head_object(Bucket=self._bucket, Key=self._index_key(name, 'ready'))
+                self._ready_indexes.add(name)
+            except ClientError:
+                return False
+        return True
+
+    def _read_index(self, name: str):
+        ret = {}
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, self._index_shards)) as executor:
+            for manifest, _ in executor.map(
+                    lambda shard: self._get_manifest(self._index_key(name, shard)), range(self._index_shards)):
+                ret.update(manifest)
+        return ret
+
+    def _update_indexes(self, id_: str, entity: T = None, previous: dict = None):
+        """
+        Record the indexed values of an entity, or drop the id when entity is None. The entries replaced are added to
+        previous, for _restore_indexes.
+        """
+        for name in self._get_indexes():
+            if entity is None:
+                manifest, old = self._write_index_entry(name, id_)
+            else:
+                manifest, old = self._write_index_entry(name, id_, self._index_value(getattr(entity, name)))
+            if previous is not None:
+                previous[name] = old
+
+            if entity is not None and name not in self._ready_indexes and len(manifest) == 1 \
+                    and self._is_only_aggregate(id_):
+                # A manifest started with the repository's first aggregate is complete.
+                self._put_manifest(self._index_key(name, 'ready'), {})
+                self._ready_indexes.add(name)
+
+    def _write_index_entry(self, name: str, id_: str, value=_ABSENT):
+        """
+        Set the id's entry in its shard of the index manifest, or drop it when no value is given. Returns the
+        manifest and the entry that was replaced.
+
+        The whole shard, about 1/_index_shards of the index, is read and rewritten with a conditional PUT, so
+        concurrent writers retry instead of overwriting each other. Write cost grows with the size of the
+        repository; raise _index_shards for repositories with many aggregates or frequent writes.
+        """
+        key = self._index_key(name, self._shard(id_))
+        for _ in range(self._index_retries):
+            manifest, etag = self._get_manifest(key)
+            old = manifest.get(id_, _ABSENT)
+            if old is value or (old is not _ABSENT and value is not _ABSENT and old == value):
+                return manifest, old
+            if value is _ABSENT:
+                del manifest[id_]
+            else:
+                manifest[id_] = value
+            if self._put_manifest(key, manifest, etag, conditional=True):
+                return manifest, old
+        raise ff.RepositoryError(f'Could not update index manifest {key}')
+
+    def _restore_indexes(self, id_: str, previous: dict):
+        """
+        Put back the entries _update_indexes replaced. An index whose old entry cannot be restored may no longer
+        match the stored aggregate, so it stops being used until rebuild_indexes runs.
+        """
+        for name, value in previous.items():
+            try:
+                self._write_index_entry(name, id_, value)
+            except ff.RepositoryError:
+                if value is not _ABSENT:
+                    self._clear_ready(name)
+
+    def _clear_ready(self, name: str):
+        self._ready_indexes.discard(name)
+        try:
+            self._s3_client.delete_object(Bucket=self._bucket, Key=self._index_key(name, 'ready'))
+        except ClientError as e:
+            raise ff.RepositoryError(str(e))
+
+    def _is_only_aggregate(self, id_: str):
+        for key in self._list_keys():
+            if key != self._key(id_):
+                return False
+        return True
+
+    def _get_manifest(self, key: str):
+        try:
+            response = self._s3_client.get_object(Bucket=self._bucket, Key=key)
+            return self._serializer.deserialize(response['Body'].read()), response.get('ETag')
+        except ClientError as e:
+            if 'NoSuchKey' in str(e):
+                return {}, None
+            raise ff.RepositoryError(str(e))
+
+    def _put_manifest(self, key: str, manifest: dict, etag: str = None, conditional: bool = False):
+        args = {'Bucket': self._bucket, 'Key': key, 'Body': self._serializer.serialize(manifest)}
+        if conditional and self._conditional_writes:
+            if etag is None:
+                args['IfNoneMatch'] = '*'
+            else:
+                args['IfMatch'] = etag
+        try:
+            self._s3_client.put_object(**args)
+        except ParamValidationError:
+            # Clients that predate S3 conditional writes fall back to last writer wins.
+            self._conditional_writes = False
+            return self._put_manifest(key, manifest)
+        except ClientError as e:
+            if 'PreconditionFailed' in str(e) or 'ConditionalRequestConflict' in str(e):
+                return False
+            raise ff.RepositoryError(str(e))
+        return True
+
+    def _index_key(self, name: str, shard):
+        return f'{self._storage_path}/_index/{name}/{shard}.json'
+
+    def _shard(self, id_: str):
+        return int(hashlib.md5(id_.encode('utf-8')).hexdigest(), 16) % self._index_shards
+
+    @staticmethod
+    def _index_value(value):
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+    def _find_by_id(self, id_: str):
+        """
+        Read-through LRU of deserialized aggregates, bounded by _cache_size. A cached aggregate is revalidated with a
+        conditional GET, so an unchanged one costs a 304 instead of a download and parse. Callers get their own copy.
+        """
+        key = self._key(id_)
+        if self._cache_size <= 0:
+            return self._load(key)
+
+        with self._entity_cache_lock:
+            cached = self._entity_cache.get(key)
+            if cached is not None:
+                self._entity_cache.move_to_end(key)
+        if cached is not None and time() - cached['validated_at'] < self._cache_ttl:
+            return deepcopy(cached['entity'])
+
+        args = {'Bucket': self._bucket, 'Key': key}
+        if cached is not None:
+            args['IfNoneMatch'] = cached['etag']
+        try:
+            response = self._s3_client.get_object(**args)
+        except ClientError as e:
+            if cached is not None and self._not_modified(e):
+                cached['validated_at'] = time()
+                return deepcopy(cached['entity'])
+            self._uncache(key)
+            if 'NoSuchKey' in str(e):
+                return None
+            raise ff.RepositoryError(str(e))
+
+        body = response['Body'].read()
+        entity = self._type().from_dict(self._serializer.deserialize(body))
+        if response.get('ETag') is not None:
+            self._cache(key, response['ETag'], deepcopy(entity), len(body))
+        return entity
+
+    def _cache(self, key: str, etag: str, entity: T, size: int):
+        if size > self._cache_size * 1024:
+            self._uncache(key)
+            return
+        with self._entity_cache_lock:
+            if key in self._entity_cache:
+                self._entity_cache_bytes -= self._entity_cache.pop(key)['size']
+            self._entity_cache[key] = {'etag': etag, 'entity': entity, 'size': size, 'validated_at': time()}
+            self._entity_cache_bytes += size
+            while self._entity_cache_bytes > self._cache_size * 1024:
+                _, evicted = self._entity_cache.popitem(last=False)
+                self._entity_cache_bytes -= evicted['size']
+
+    def _uncache(self, key: str):
+        with self._entity_cache_lock:
+            if key in self._entity_cache:
+                self._entity_cache_bytes -= self._entity_cache.pop(key)['size']
+
+    @staticmethod
+    def _not_modified(e: ClientError):
+        return e.response.get('Error', {}).get('Code') in ('304', 'NotModified') \
+            or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304
+
+    def _scan(self, criteria: ff.BinaryOp = None, expression: str = None):
+        snapshot = self._get_snapshot() if self._snapshots else None
+        if snapshot is None:
+            return self._stream(criteria, expression=expression)
+        return self._stream_snapshot(snapshot, criteria, expression)
+
+    def _stream_snapshot(self, snapshot: dict, criteria: ff.BinaryOp = None, expression: str = None):
+        """
+        Yield the snapshot's records that match the criteria, reading the segments with parallel ranged GETs (or S3
+        Select scan ranges) aligned on record boundaries, then the aggregates written since from their own objects.
+        """
+        changed = self._read_deltas(snapshot['since'])
+        ranges = [(segment['key'], start, end) for segment in snapshot['segments'] for start, end in segment['blocks']]
+        results = self._map(lambda r: self._load_range(*r, criteria, expression, changed), ranges)
+        try:
+            for entities in results:
+                yield from entities
+            yield from self._stream(
+                criteria, keys=[self._key(id_) for id_, op in changed.items() if op == 'put'], expression=expression
+            )
+        finally:
+            results.close()
+
+    def _load_range(self, key: str, start: int, end: int, criteria: ff.BinaryOp, expression: Optional[str],
+                    changed: dict):
+        body = False
+        if expression is not None:
+            body = self._select_object(key, expression, scan_range=(start, end))
+        if body is False:
+            try:
+                body = self._s3_client.get_object(Bucket=self._bucket, Key=key, Range=f'bytes={start}-{end}')['Body']\
+                    .read()
+            except ClientError as e:
+                raise ff.RepositoryError(str(e))
+
+        ret = []
+        for line in (body or b'').splitlines():
+            if len(line.strip()) == 0:
+                continue
+            entity = self._type().from_dict(self._serializer.deserialize(line))
+            if entity.id_value() in changed or (criteria is not None and not criteria.matches(entity)):
+                continue
+            ret.append(entity)
+        return ret
+
+    def _get_snapshot(self):
+        manifest, _ = self._get_manifest(self._snapshot_key('manifest'))
+        return manifest if 'segments' in manifest else None
+
+    def _put_segment(self, snapshot_id: str, number: int, buffer: bytearray, blocks: list):
+        key = self._snapshot_key(f'segments/{snapshot_id}-{number:05d}')
+        try:
+            self._s3_client.put_object(Bucket=self._bucket, Key=key, Body=bytes(buffer))
+        except ClientError as e:
+            raise ff.RepositoryError(str(e))
+        start = blocks[-1][1] + 1 if len(blocks) > 0 else 0
+        if start < len(buffer):
+            blocks.append([start, len(buffer) - 1])
+        return {'key': key, 'size': len(buffer), 'blocks': blocks}
+
+    def _write_delta(self, written_at: int, op: str, id_: str):
+        if not self._snapshots:
+            return
+        try:
+            self._s3_client.put_object(
+                Bucket=self._bucket, Key=self._snapshot_key(f'deltas/{written_at:020d}-{op}-{id_}'), Body=b''
+            )
+        except ClientError as e:
+            raise ff.RepositoryError(str(e))
+
+    def _read_deltas(self, since: int):
+        """
+        Latest operation per id among the writes logged since the snapshot was taken.
+        """
+        prefix = self._snapshot_key('deltas/')
+        ret = {}
+        for key in self._list(prefix, start_after=f'{prefix}{since:020d}'):
+            _, op, id_ = key[len(prefix):].split('-', 2)
+            ret[id_] = op
+        return ret
+
+    def _delete(self, keys: list):
+        for i in range(0, len(keys), 1000):
+            try:
+                self._s3_client.delete_objects(
+                    Bucket=self._bucket, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True}
+                )
+            except ClientError as e:
+                raise ff.RepositoryError(str(e))
+
+    def _snapshot_key(self, name: str):
+        return f'{self._storage_path}/_snapshot/{name}'
+
+    def _key(self, id_: str):
+        return f'{self._storage_path}/{id_}.json'
+
+    def _list_keys(self):
+        """
+        Yield the key of every aggregate in the repository, in key order, one list_objects_v2 page at a time. Objects
+        in sub-prefixes are not aggregates and are skipped.
+        """
+        prefix = f'{self._storage_path}/'
+        for key in self._list(prefix):
+            name = key[len(prefix):]
+            if '/' not in name and name.endswith('.json'):
+                yield key
+
+    def _list(self, prefix: str, start_after: str = None, end_before: str = None):
+        args = {'Bucket': self._bucket, 'Prefix': prefix, 'MaxKeys': self._list_page_size}
+        if start_after is not None:
+            args['StartAfter'] = start_after
+        while True:
+            try:
+                response = self._s3_client.list_objects_v2(**args)
+            except ClientError as e:
+                raise ff.RepositoryError(str(e))
+
+            for obj in response.get('Contents', []):
+                if end_before is not None and obj['Key'] >= end_before:
+                    return
+                yield obj['Key']
+
+            if not response.get('IsTruncated'):
+                break
+            args['ContinuationToken'] = response['NextContinuationToken']
+
+    def _stream(self, criteria: ff.BinaryOp = None, keys: list = None, ordered: bool = False,
+                expression: str = None):
+        """
+        Yield the entities stored under keys (every aggregate by default) that match the criteria. Objects are fetched
+        on a pool of _max_workers threads while the listing continues, and the criteria are evaluated on the worker
+        that fetched the object. Entities are yielded as their GETs complete, or in key order when ordered=True.
+        With an S3 Select expression, objects that do not match it are not transferred at all.
+        """
+        keys = self._list_keys() if keys is None else keys
+        results = self._map(lambda key: self._load(key, criteria, expression), keys, ordered)
+        try:
+            yield from filter(lambda e: e is not None, results)
+        finally:
+            results.close()
+
+    def _map(self, fn: Callable, items, ordered: bool = False):
+        """
+        Yield fn(item) for every item, running at most _max_workers calls at a time and keeping a bounded window of
+        submitted work so that items are consumed lazily.
+        """
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        pending = []
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= self._max_workers * 2:
+                    done, pending = self._completed(pending, ordered)
+                    yield from done
+
+            while len(pending) > 0:
+                done, pending = self._completed(pending, ordered)
+                yield from done
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _select_object(self, key: str, expression: str, scan_range: tuple = None):
+        """
+        The matching records of the object (or of the JSON Lines records starting in scan_range), None if there are
+        none, or False when S3 Select could not evaluate it (records over 1 MB, type errors) and it has to be read
+        whole.
+        """
+        args = {'InputSerialization': {'JSON': {'Type': 'DOCUMENT'}}}
+        if scan_range is not None:
+            args = {
+                'InputSerialization': {'JSON': {'Type': 'LINES'}},
+                'ScanRange': {'Start': scan_range[0], 'End': scan_range[1]},
+            }
+        try:
+            response = self._s3_client.select_object_content(
+                Bucket=self._bucket,
+                Key=key,
+                ExpressionType='SQL',
+                Expression=f'SELECT * FROM S3Object s WHERE {expression}',
+                OutputSerialization={'JSON': {}},
+                **args
+            )
+            body = b''.join(event['Records']['Payload'] for event in response['Payload'] if 'Records' in event)
+        except ClientError as e:
+            if 'NoSuchKey' in str(e):
+                return None
+            self.debug('S3 Select failed for %s, reading the object instead: %s', key, str(e))
+            return False
+        return body if len(body.strip()) > 0 else None
+
+    @staticmethod
+    def _completed(pending: list, ordered: bool):
+        if ordered:
+            return [pending[0].result()], pending[1:]
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        return [future.result() for future in done], [future for future in pending if future in not_done]
+
+    def _load(self, key: str, criteria: ff.BinaryOp = None, expression: str = None):
+        body = self._select_object(key, expression) if expression is not None else False
+        if body is None:
+            return None
+
+        if body is False:
+            try:
+                body = self._s3_client.get_object(Bucket=self._bucket, Key=key)['Body'].read()
+            except ClientError as e:
+                if 'NoSuchKey' in str(e):
+                    return None
+                raise ff.RepositoryError(str(e))
+
+        entity = self._type().from_dict(self._serializer.deserialize(body))
+        if criteria is not None and not criteria.matches(entity):
+            return None
+        return entity
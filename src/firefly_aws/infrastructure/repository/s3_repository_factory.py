@@ -37,6 +37,11 @@ class S3RepositoryFactory(ff.RepositoryFactory):
 
         config = self._context_map.get_context('firefly_aws').config
 
-        return Repo(
-            self._container.s3_client, self._container.serializer, bucket=config.get('bucket'), prefix=self._prefix
+        # Built through the container so the repository gets its logger like any other service.
+        return self._container.build(
+            Repo,
+            s3_client=self._container.s3_client,
+            serializer=self._container.serializer,
+            bucket=config.get('bucket'),
+            prefix=self._prefix
         )
@@ -15,3 +15,4 @@
 from .boto_message_transport import BotoMessageTransport
 from .boto_s3_service import BotoS3Service
 from .cognito_jwt_decoder import CognitoJwtDecoder
+from .sqlite_rds_data_client import SqliteRdsDataClient
@@ -0,0 +1,268 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import sqlite3
+import uuid
+from threading import RLock
+
+from botocore.exceptions import ClientError
+
+
+class SqliteRdsDataClient:
+    """
+    Stand-in for boto3.client('rds-data') on top of SQLite, for benchmarks and tests without an Aurora cluster.
+
+    It implements execute_statement, batch_execute_statement and the transaction calls with the Data API's typed
+    value records, and raises the same errors for responses over _response_size_limit and requests over
+    _request_size_limit. MySQL databases become attached SQLite databases, in memory or one file per database under
+    path, and the MySQL features the Data API storage interfaces rely on are translated: inline and named indexes,
+    column renames, information_schema lookups, JSON_EXTRACT/JSON_UNQUOTE/JSON_VALID, CONCAT, CEIL and CHAR_LENGTH.
+
+    Set FIREFLY_AWS_DATA_API_SQLITE to ':memory:' or a directory to have the container use it.
+    """
+    _response_size_limit: int = 1024 * 1024  # In bytes
+    _request_size_limit: int = 4 * 1024 * 1024  # In bytes
+
+    def __init__(self, path: str = ':memory:'):
+        self._path = path
+        self._lock = RLock()
+        self._connection = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        self._databases = set()
+        self._transaction_id = None
+
+        self._connection.create_function('CEIL', 1, self._ceil, deterministic=True)
+        self._connection.create_function('CONCAT', -1, self._concat, deterministic=True)
+        self._connection.create_function('CHAR_LENGTH', 1, self._char_length, deterministic=True)
+        self._connection.create_function('JSON_EXTRACT', 2, self._json_extract, deterministic=True)
+        self._connection.create_function('JSON_UNQUOTE', 1, self._json_unquote, deterministic=True)
+        self._connection.create_function('JSON_VALID', 1, self._json_valid, deterministic=True)
+
+    def execute_statement(self, sql: str, parameters: list = None, transactionId: str = None, **kwargs):
+        self._check_transaction(transactionId)
+        with self._lock:
+            rows, count = self._execute(sql, self._parameters(parameters or []))
+
+        ret = {'numberOfRecordsUpdated': count}
+        if rows is not None:
+            ret['records'] = [[self._value(v) for v in row] for row in rows]
+            if len(json.dumps(ret['records'], default=str)) > self._response_size_limit:
+                raise self._error('Database returned more than the allowed response size limit', 'ExecuteStatement')
+        return ret
+
+    def batch_execute_statement(self, sql: str, parameterSets: list = None, transactionId: str = None, **kwargs):
+        self._check_transaction(transactionId)
+        if len(json.dumps(parameterSets or [], default=str)) > self._request_size_limit:
+            raise self._error('Request payload size exceeded', 'BatchExecuteStatement')
+
+        with self._lock:
+            own_transaction = self._transaction_id is None
+            if own_transaction:
+                self._connection.execute('begin')
+            try:
+                for params in parameterSets or []:
+                    self._execute(sql, self._parameters(params))
+            except ClientError as e:
+                if own_transaction:
+                    self._connection.execute('rollback')
+                raise e
+            if own_transaction:
+                self._connection.execute('commit')
+
+        return {'updateResults': [{'generatedFields': []} for _ in parameterSets or []]}
+
+    def begin_transaction(self, **kwargs):
+        with self._lock:
+            if self._transaction_id is not None:
+                raise self._error('Only one transaction at a time is supported', 'BeginTransaction')
+            self._connection.execute('begin')
+            self._transaction_id = str(uuid.uuid4())
+            return {'transactionId': self._transaction_id}
+
+    def commit_transaction(self, transactionId: str, **kwargs):
+        self._end_transaction(transactionId, 'commit')
+        return {'transactionStatus': 'Transaction Committed'}
+
+    def rollback_transaction(self, transactionId: str, **kwargs):
+        self._end_transaction(transactionId, 'rollback')
+        return {'transactionStatus': 'Rollback Complete'}
+
+    def _end_transaction(self, transaction_id: str, statement: str):
+        with self._lock:
+            if transaction_id is None or transaction_id != self._transaction_id:
+                raise self._error(f'Transaction {transaction_id} is not found', 'CommitTransaction')
+            self._transaction_id = None
+            self._connection.execute(statement)
+
+    def _check_transaction(self, transaction_id: str = None):
+        if transaction_id is not None and transaction_id != self._transaction_id:
+            raise self._error(f'Transaction {transaction_id} is not found', 'ExecuteStatement')
+
+    def _execute(self, sql: str, params: dict):
+        sql = ' '.join(sql.split())
+
+        m = re.match(r'create database if not exists `?(\w+)`?$', sql, re.IGNORECASE)
+        if m:
+            self._attach(m.group(1))
+            return None, 0
+
+        if 'information_schema' in sql.lower():
+            return self._information_schema(sql), 0
+
+        statements = self._translate(sql)
+        try:
+            for statement in statements[:-1]:
+                self._connection.execute(statement)
+            cursor = self._connection.execute(statements[-1], params)
+            rows = cursor.fetchall() if cursor.description is not None else None
+            return rows, max(cursor.rowcount, 0)
+        except sqlite3.Error as e:
+            raise self._error(str(e), 'ExecuteStatement')
+
+    def _attach(self, database: str):
+        if database in self._databases:
+            return
+        path = ':memory:' if self._path == ':memory:' else os.path.join(self._path, f'{database}.db')
+        self._connection.execute('attach database ? as ' + database, (path,))
+        self._databases.add(database)
+
+    def _translate(self, sql: str):
+        """
+        Rewrite MySQL-only syntax. Returns the SQLite statements to run in order; only the last one takes parameters.
+        """
+        sql = sql.replace("CAST('null' AS JSON)", "'null'")
+
+        # MySQL index names are per table, SQLite's are per database, so indexes are stored as <table>__<name>.
+
+        m = re.match(r'create table if not exists (\w+)\.(\w+) \((.*)\)$', sql, re.IGNORECASE)
+        if m:
+            schema, table, body = m.groups()
+            ret = []
+            for name, column in re.findall(r'INDEX `?(\w+)`? \(`?(\w+)`?\)', body):
+                ret.append(f'create index if not exists {schema}.{table}__{name} on {table} (`{column}`)')
+            body = re.sub(r',\s*INDEX `?\w+`? \(`?\w+`?\)', '', body)
+            return [f'create table if not exists {schema}.{table} ({body})'] + ret
+
+        m = re.match(r'create index `?(\w+)`? on (\w+)\.(\w+) \((.*)\)$', sql, re.IGNORECASE)
+        if m:
+            return [f'create index {m.group(2)}.{m.group(3)}__{m.group(1)} on {m.group(3)} ({m.group(4)})']
+
+        m = re.match(r'drop index `?(\w+)`? on (\w+)\.(\w+)$', sql, re.IGNORECASE)
+        if m:
+            return [f'drop index {m.group(2)}.{m.group(3)}__{m.group(1)}']
+
+        m = re.match(r'alter table (\w+\.\w+) change column `?(\w+)`? `?(\w+)`? .*$', sql, re.IGNORECASE)
+        if m:
+            return [f'alter table {m.group(1)} rename column `{m.group(2)}` to `{m.group(3)}`']
+
+        return [sql]
+
+    def _information_schema(self, sql: str):
+        table = re.search(r"table_name = '(\w+)'", sql, re.IGNORECASE).group(1)
+        schema = re.search(r"table_schema = '(\w+)'", sql, re.IGNORECASE).group(1)
+        if schema not in self._databases:
+            return []
+
+        if 'information_schema.statistics' in sql.lower():
+            ret = []
+            for index in self._connection.execute(f'pragma {schema}.index_list({table})').fetchall():
+                if index[3] != 'c':
+                    continue
+                for column in self._connection.execute(f'pragma {schema}.index_info({index[1]})').fetchall():
+                    ret.append((column[2],))
+            return ret
+
+        if 'information_schema.columns' in sql.lower():
+            columns = self._connection.execute(f'pragma {schema}.table_xinfo({table})').fetchall()
+            return [(column[1],) for column in columns if column[6] in (2, 3)]
+
+        # Table statistics such as avg_row_length are not tracked.
+        return [(None,)]
+
+    @staticmethod
+    def _parameters(params: list):
+        ret = {}
+        for param in params:
+            (key, value), = param['value'].items()
+            ret[param['name']] = None if key == 'isNull' else value
+        return ret
+
+    @staticmethod
+    def _value(value):
+        if value is None:
+            return {'isNull': True}
+        if isinstance(value, bool):
+            return {'booleanValue': value}
+        if isinstance(value, int):
+            return {'longValue': value}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        if isinstance(value, bytes):
+            return {'blobValue': value}
+        return {'stringValue': value}
+
+    @staticmethod
+    def _ceil(value):
+        return None if value is None else math.ceil(value)
+
+    @staticmethod
+    def _char_length(value):
+        return None if value is None else len(value)
+
+    @staticmethod
+    def _concat(*args):
+        if any(a is None for a in args):
+            return None
+        return ''.join(map(str, args))
+
+    @staticmethod
+    def _json_extract(document: str, path: str):
+        """
+        MySQL returns JSON, so strings keep their quotes and null is the JSON literal. Numbers are returned as numbers
+        so they compare the way MySQL compares JSON numbers.
+        """
+        if document is None:
+            return None
+        value = json.loads(document)
+        for key in re.findall(r'\.(\w+)|\[(\d+)\]', path):
+            try:
+                value = value[key[0]] if key[0] else value[int(key[1])]
+            except (KeyError, IndexError, TypeError):
+                return None
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        return json.dumps(value)
+
+    @staticmethod
+    def _json_valid(document: str):
+        try:
+            json.loads(document)
+            return 1
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _json_unquote(value):
+        if isinstance(value, str) and value.startswith('"'):
+            return json.loads(value)
+        return value
+
+    @staticmethod
+    def _error(message: str, operation: str):
+        return ClientError({'Error': {'Code': 'BadRequestException', 'Message': message}}, operation)
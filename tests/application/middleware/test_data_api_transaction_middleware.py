@@ -0,0 +1,103 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import pytest
+from botocore.exceptions import ClientError
+from firefly_aws.application.middleware import DataApiTransactionMiddleware
+from firefly_aws.infrastructure import DataApiUnitOfWork
+
+from tests.conftest import Widget, _Logger
+
+
+class _Event:
+    def __init__(self, name: str):
+        self.name = name
+
+    def to_dict(self):
+        return {'name': self.name}
+
+
+class _Repository:
+    def __init__(self, storage, entities: list):
+        self._storage = storage
+        self._entities = entities
+
+    def reset(self):
+        pass
+
+    def commit(self):
+        for entity in self._entities:
+            self._storage.add(entity)
+
+
+class _Registry:
+    def __init__(self, *repositories):
+        self._repositories = repositories
+
+    def get_repositories(self):
+        return self._repositories
+
+
+class _SystemBus:
+    def __init__(self, check):
+        self.dispatched = []
+        self._check = check
+
+    def dispatch(self, event, data: dict = None):
+        self.dispatched.append((event.name, self._check()))
+
+
+@pytest.fixture()
+def middleware(storage):
+    unit_of_work = DataApiUnitOfWork()
+    unit_of_work._logger = _Logger()
+    storage._data_api_unit_of_work = unit_of_work
+
+    ret = DataApiTransactionMiddleware()
+    ret._data_api_unit_of_work = unit_of_work
+    ret._logger = _Logger()
+    ret._system_bus = _SystemBus(lambda: len(storage.all(Widget)))
+    return ret
+
+
+def _handle(middleware, event):
+    def next_(message):
+        middleware._event_buffer.append(event)
+        return message
+
+    return middleware(object(), next_)
+
+
+def test_rows_are_written_before_events_are_dispatched(middleware, storage):
+    middleware._registry = _Registry(_Repository(storage, [Widget(name='a'), Widget(name='b')]))
+    _handle(middleware, _Event('WidgetsCreated'))
+
+    assert middleware._system_bus.dispatched == [('WidgetsCreated', 2)]
+
+
+def test_failed_flush_dispatches_nothing(middleware, storage, rds_data_client):
+    def fail(*args, **kwargs):
+        raise ClientError({'Error': {'Code': 'BadRequestException', 'Message': 'failed'}}, 'BatchExecuteStatement')
+
+    rds_data_client.batch_execute_statement = fail
+    middleware._registry = _Registry(_Repository(storage, [Widget(name='a')]))
+    with pytest.raises(ClientError):
+        _handle(middleware, _Event('WidgetsCreated'))
+
+    assert middleware._system_bus.dispatched == []
+    assert middleware._level == 0
+    assert not middleware._data_api_unit_of_work.is_active()
+    assert len(storage.all(Widget)) == 0
@@ -0,0 +1,194 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import hashlib
+from datetime import datetime
+from threading import Lock
+
+import firefly as ff
+import firefly.infrastructure as ffi
+import pytest
+from botocore.exceptions import ClientError
+from firefly_aws.infrastructure import DataApiMysqlStorageInterface, DataApiMysqlMappedStorageInterface, \
+    SqliteRdsDataClient
+
+
+class Widget(ff.AggregateRoot):
+    id: str = ff.id_()
+    name: str = ff.required(index=True)
+    size: int = ff.optional(default=0)
+    payload: str = ff.optional(default='')
+    created_on: datetime = ff.optional()
+
+
+class Document(ff.AggregateRoot):
+    id: str = ff.id_()
+    name: str = ff.required(index=True)
+    updated_on: datetime = ff.optional()
+    deleted_on: datetime = ff.optional()
+
+
+class Gadget(ff.AggregateRoot):
+    id: str = ff.id_()
+    name: str = ff.required(index=True)
+    size: int = ff.optional(default=0)
+    weight: float = ff.optional(default=0.0)
+
+
+class Reading(ff.AggregateRoot):
+    id: str = ff.id_()
+    sensor: str = ff.required(index=True)
+    taken_on: datetime = ff.optional(index=True)
+    value: float = ff.optional(index=True)
+    count: int = ff.optional()
+    attributes: dict = ff.dict_()
+
+
+class _Logger:
+    def __getattr__(self, item):
+        return lambda *args, **kwargs: None
+
+
+class _SplitAttribute(ff.AttributeString):
+    """
+    Attribute the way newer firefly versions keep it: the function calls apart from the field name.
+    """
+
+    def __new__(cls, name: str, modifiers: list):
+        ret = super().__new__(cls, name)
+        ret.modifiers = modifiers
+        return ret
+
+    def get_modifiers(self):
+        return self.modifiers
+
+
+class _Body:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+class _S3Client:
+    """
+    In-memory stand-in for boto3.client('s3') with the calls S3Repository and the table metadata cache make,
+    including conditional and ranged requests. Every call is counted in calls.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = {}
+        self._lock = Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body, IfMatch: str = None, IfNoneMatch: str = None):
+        self._count('put_object')
+        data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == '*' and current is not None) or \
+                    (IfMatch is not None and (current is None or current['etag'] != IfMatch)):
+                raise self._error('PreconditionFailed', 'PutObject')
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            self.objects[(Bucket, Key)] = {'body': data, 'etag': etag}
+        return {'ETag': etag}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, IfNoneMatch: str = None):
+        self._count('get_object')
+        obj = self._get(Bucket, Key)
+        if IfNoneMatch is not None and IfNoneMatch == obj['etag']:
+            raise self._error('304', 'GetObject')
+        body = obj['body']
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+        return {'Body': _Body(body), 'ETag': obj['etag']}
+
+    def head_object(self, Bucket: str, Key: str):
+        self._count('head_object')
+        return {'ETag': self._get(Bucket, Key)['etag']}
+
+    def delete_object(self, Bucket: str, Key: str):
+        self._count('delete_object')
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+
+    def delete_objects(self, Bucket: str, Delete: dict):
+        self._count('delete_objects')
+        with self._lock:
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', MaxKeys: int = 1000, StartAfter: str = None,
+                        ContinuationToken: str = None):
+        self._count('list_objects_v2')
+        with self._lock:
+            keys = sorted(k for b, k in self.objects.keys() if b == Bucket and k.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after is not None:
+            keys = [k for k in keys if k > after]
+        ret = {'Contents': [{'Key': k} for k in keys[:MaxKeys]], 'IsTruncated': len(keys) > MaxKeys}
+        if ret['IsTruncated']:
+            ret['NextContinuationToken'] = keys[MaxKeys - 1]
+        return ret
+
+    def _get(self, bucket: str, key: str):
+        with self._lock:
+            if (bucket, key) not in self.objects:
+                raise self._error('NoSuchKey', 'GetObject')
+            return self.objects[(bucket, key)]
+
+    def _count(self, call: str):
+        with self._lock:
+            self.calls[call] = self.calls.get(call, 0) + 1
+
+    @staticmethod
+    def _error(code: str, operation: str):
+        return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def build_storage(cls=DataApiMysqlStorageInterface, client: SqliteRdsDataClient = None, **kwargs):
+    storage = cls(**kwargs)
+    storage._rds_data_client = client or SqliteRdsDataClient()
+    storage._serializer = ffi.JsonSerializer()
+    storage._db_name = 'tests'
+    storage._logger = _Logger()
+    return storage
+
+
+@pytest.fixture(autouse=True)
+def no_retry_wait(monkeypatch):
+    monkeypatch.setattr('firefly.domain.utils.sleep', lambda seconds: None)
+
+
+@pytest.fixture()
+def rds_data_client():
+    return SqliteRdsDataClient()
+
+
+@pytest.fixture()
+def storage(rds_data_client):
+    ret = build_storage(client=rds_data_client)
+    ret._execute_ddl(Widget)
+    return ret
+
+
+@pytest.fixture()
+def mapped_storage(rds_data_client):
+    ret = build_storage(DataApiMysqlMappedStorageInterface, client=rds_data_client)
+    ret._execute_ddl(Gadget)
+    return ret
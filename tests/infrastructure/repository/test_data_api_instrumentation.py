@@ -0,0 +1,74 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import firefly as ff
+from firefly_aws.infrastructure import DataApiInstrumentation
+
+from tests.conftest import Widget, _Logger
+
+
+def _instrumentation():
+    ret = DataApiInstrumentation()
+    ret._emit_interval = None
+    ret._logger = _Logger()
+    return ret
+
+
+def _templates(storage, prefix: str):
+    return [t for t in storage._data_api_instrumentation.stats().keys() if t.startswith(prefix)]
+
+
+def test_templates_do_not_vary_with_id_counts(storage):
+    storage._data_api_instrumentation = _instrumentation()
+    widgets = [Widget(name=f'widget-{i}', size=i) for i in range(60)]
+    storage.add_many(widgets)
+
+    for count in (1, 2, 5, 13, 40):
+        assert len(storage.find_many(Widget, [w.id for w in widgets[:count]])) == count
+        assert len(storage.all(Widget, ff.Attr('size').is_in(list(range(count))))) == count
+    for count in (1, 2, 5, 13):
+        storage.remove_many(widgets[:count])
+        widgets = widgets[count:]
+
+    # The table statistics, find_many and the pushed-down `in` criteria.
+    assert len(_templates(storage, 'select')) == 3
+    assert len(_templates(storage, 'delete')) == 1
+    assert '(:id, ...)' in _templates(storage, 'delete')[0]
+
+
+def test_templates_do_not_vary_with_limits_or_offsets(storage, rds_data_client):
+    storage._data_api_instrumentation = _instrumentation()
+    storage._size_limit = 4
+    rds_data_client._response_size_limit = 8 * 1024
+    widgets = [Widget(name=f'widget-{i}', payload='x' * 1000 * i) for i in (10, 20, 30)]
+    storage.add_many(widgets)
+
+    for widget in widgets:
+        assert len(storage.find(widget.id, Widget).payload) == len(widget.payload)
+
+    chunk_reads = _templates(storage, 'select SUBSTR')
+    assert len(chunk_reads) == 1
+    assert 'SUBSTR(obj, ?, ?)' in chunk_reads[0]
+
+
+def test_storage_records_pages_under_one_template(storage):
+    storage._data_api_instrumentation = _instrumentation()
+    storage.add_many([Widget(name=f'widget-{i}', size=i) for i in range(50)])
+    storage._select_limits['Widget'] = 7
+    assert len(storage.all(Widget)) == 50
+
+    templates = [t for t in storage._data_api_instrumentation.stats().keys() if t.startswith('select')]
+    assert len(templates) < 5
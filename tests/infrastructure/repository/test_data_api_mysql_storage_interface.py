@@ -0,0 +1,196 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import firefly as ff
+import pytest
+
+from datetime import datetime, timedelta
+
+from firefly_aws.infrastructure.service.sqlite_rds_data_client import SqliteRdsDataClient
+from tests.conftest import Gadget, Widget, build_storage, _SplitAttribute
+
+
+def _widgets(storage, count: int, **kwargs):
+    ret = [Widget(name=f'widget-{i:05d}', size=i, **kwargs) for i in range(count)]
+    storage.add_many(ret)
+    return ret
+
+
+def test_criteria_on_document_fields_run_in_sql(storage):
+    _widgets(storage, 300)
+    calls = []
+    storage._fetch_multiple_large_documents = lambda *args, **kwargs: calls.append(args)
+
+    assert sorted(w.size for w in storage.all(Widget, ff.Attr('size') > 250)) == list(range(251, 300))
+    assert [w.size for w in storage.all(Widget, ff.Attr('name').lower() == 'widget-00007')] == [7]
+    assert sorted(w.size for w in storage.all(Widget, (ff.Attr('size') < 2) | (ff.Attr('payload') == 'x'))) == [0, 1]
+    assert len(calls) == 0
+
+
+def test_push_down_renders_document_paths(storage):
+    criteria, exact = storage._push_down(Widget, (ff.Attr('size') > 250) & (ff.Attr('name') == 'a'))
+    clause, params = storage._generate_where_clause(criteria)
+
+    assert exact
+    assert "JSON_EXTRACT(obj, '$.size') > :var1" in clause
+    assert '`name` = :var2' in clause
+    assert [p['name'] for p in params] == ['var1', 'var2']
+
+
+def test_attributes_with_separate_function_calls(storage):
+    _widgets(storage, 20)
+
+    criteria = ff.BinaryOp(_SplitAttribute('name', ['UPPER']), '==', 'WIDGET-00003')
+    assert [w.size for w in storage.all(Widget, criteria)] == [3]
+    criteria = ff.BinaryOp(_SplitAttribute('size', []), '>', 17)
+    assert sorted(w.size for w in storage.all(Widget, criteria)) == [18, 19]
+
+
+def test_fast_paths_use_pushed_down_criteria(storage):
+    _widgets(storage, 100)
+
+    assert sorted(r['size'] for r in storage.project(Widget, ['size'], ff.Attr('size') >= 98)) == [98, 99]
+    assert storage.aggregate(Widget, {'n': ('count', None)}, ff.Attr('size') < 10) == {'n': 10}
+    assert storage.remove_where(Widget, ff.Attr('size') >= 50) == 50
+    assert len(storage.all(Widget)) == 50
+
+
+def test_generated_index_columns_are_materialized_with_their_values(rds_data_client):
+    storage = build_storage(client=rds_data_client, generated_indexes=True)
+    storage._execute_ddl(Widget)
+    _widgets(storage, 20)
+    assert storage._get_generated_columns(Widget) == ['name']
+
+    storage = build_storage(client=rds_data_client)
+    storage._execute_ddl(Widget)
+
+    assert storage._get_generated_columns(Widget) == []
+    assert storage._get_table_indexes(Widget) == ['name']
+    result = storage._exec(f"select `name` from {storage._fqtn(Widget)} where `name` = 'widget-00007'", [])
+    assert result['records'] == [[{'stringValue': 'widget-00007'}]]
+    storage.add(Widget(name='new', size=20))
+    assert [w.size for w in storage.all(Widget, ff.Attr('name') == 'new')] == [20]
+
+
+def _codec_storage(rds_data_client, codec):
+    ret = build_storage(client=rds_data_client, codecs={'Widget': codec})
+    ret._execute_ddl(Widget)
+    return ret
+
+
+def _stored_documents(storage):
+    return [row[0]['stringValue'] for row in storage._exec(f"select obj from {storage._fqtn(Widget)}", [])['records']]
+
+
+def test_zlib_documents_round_trip(rds_data_client):
+    storage = _codec_storage(rds_data_client, 'zlib')
+    widgets = _widgets(storage, 30, payload='compressible ' * 50)
+
+    assert all(d.startswith('zlib:') for d in _stored_documents(storage))
+    assert storage.find(widgets[3].id, Widget).payload == 'compressible ' * 50
+    assert sorted(w.size for w in storage.all(Widget, ff.Attr('size') > 26)) == [27, 28, 29]
+    assert sorted(w.size for w in storage.all(Widget, ff.Attr('name') == 'widget-00004')) == [4]
+
+
+def test_zstd_documents_round_trip(rds_data_client):
+    pytest.importorskip('zstandard')
+    storage = _codec_storage(rds_data_client, 'zstd')
+    widgets = _widgets(storage, 10)
+
+    assert all(d.startswith('zstd:') for d in _stored_documents(storage))
+    assert storage.find(widgets[3].id, Widget).size == 3
+
+
+def test_documents_stay_readable_when_the_codec_changes(rds_data_client):
+    legacy = _codec_storage(rds_data_client, None)
+    old = _widgets(legacy, 5)
+    assert not any(d.startswith('zlib:') for d in _stored_documents(legacy))
+
+    compressed = _codec_storage(rds_data_client, 'zlib')
+    new = Widget(name='new', size=50)
+    compressed.add(new)
+    old[0].size = 40
+    compressed.update(old[0])
+    assert sorted(w.size for w in compressed.all(Widget)) == [1, 2, 3, 4, 40, 50]
+    assert compressed.find(old[1].id, Widget).size == 1
+
+    # Mapped to None, so the zlib rows written above are filtered in Python rather than with JSON_EXTRACT.
+    plain = _codec_storage(rds_data_client, None)
+    assert plain.find(new.id, Widget).size == 50
+    assert sorted(w.size for w in plain.all(Widget, ff.Attr('size') >= 40)) == [40, 50]
+    assert sorted(r['size'] for r in plain.project(Widget, ['size'], ff.Attr('size') < 3)) == [1, 2]
+    assert plain.aggregate(Widget, {'n': ('count', None), 'top': ('max', 'size')}) == {'n': 6, 'top': 50}
+
+
+def test_large_compressed_documents_are_chunked(rds_data_client):
+    storage = _codec_storage(rds_data_client, 'zlib')
+    storage._size_limit = 4
+    rds_data_client._response_size_limit = 8 * 1024
+    widget = Widget(name='large', payload=''.join(f'{i:06d}' for i in range(5000)))
+    storage.add(widget)
+
+    assert storage.find(widget.id, Widget).payload == widget.payload
+
+
+def test_unknown_codecs_are_rejected():
+    with pytest.raises(ff.ConfigurationError):
+        build_storage(codecs={'Widget': 'lz4'})
+
+
+_AGGREGATES = {
+    'n': ('count', None),
+    'sized': ('count', 'size'),
+    'total': ('sum', 'weight'),
+    'low': ('min', 'size'),
+    'high': ('max', 'weight'),
+    'mean': ('avg', 'weight'),
+}
+
+
+def _gadget_storages():
+    gadgets = [Gadget(name=f'gadget-{i % 3}', size=i % 4, weight=i * 0.25) for i in range(40)]
+    ret = []
+    for codec in (None, 'zlib'):
+        storage = build_storage(client=SqliteRdsDataClient(), codecs={'Gadget': codec})
+        storage._execute_ddl(Gadget)
+        storage.add_many(gadgets)
+        ret.append(storage)
+    return ret
+
+
+@pytest.mark.parametrize('group_by', [None, ['name'], ['size'], ['name', 'size']])
+def test_aggregates_match_between_sql_and_the_in_memory_fallback(group_by):
+    # The zlib storage holds the same rows but has to aggregate them in memory.
+    sql, fallback = _gadget_storages()
+
+    for criteria in (None, ff.Attr('size') > 1, ff.Attr('weight') > 100):
+        expected = sql.aggregate(Gadget, _AGGREGATES, criteria, group_by)
+        assert fallback.aggregate(Gadget, _AGGREGATES, criteria, group_by) == expected
+
+
+def test_aggregates_skip_nulls_the_same_way_on_both_paths(storage):
+    start = datetime(2020, 1, 1)
+    storage.add_many([
+        Widget(name=f'widget-{i}', size=i % 3, created_on=start + timedelta(days=i) if i % 2 else None)
+        for i in range(10)
+    ])
+    aggregates = {'n': ('count', None), 'dated': ('count', 'created_on'), 'first': ('min', 'created_on')}
+
+    for group_by in ([], ['size']):
+        documents = storage._all(Widget, stream=True, raw=True)
+        expected = storage._aggregate(Widget, aggregates, None, group_by)
+        assert storage._aggregate_documents(documents, aggregates, group_by) == expected
+    assert storage.aggregate(Widget, aggregates) == {'n': 10, 'dated': 5, 'first': '2020-01-02T00:00:00'}
@@ -0,0 +1,497 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+import threading
+from datetime import datetime
+
+import firefly as ff
+import pytest
+from firefly_aws.infrastructure import DataApiMysqlMappedStorageInterface, DataApiMysqlStorageInterface, \
+    DataApiUnitOfWork
+
+from tests.conftest import Document, Gadget, Reading, Widget, _Logger, _S3Client, build_storage
+
+
+def test_add_many_keeps_batches_under_the_request_limit(storage, rds_data_client):
+    payload = '"quoted" ' * 5600
+    sizes = []
+    batch_execute_statement = rds_data_client.batch_execute_statement
+
+    def measure(sql: str, parameterSets: list = None, **kwargs):
+        sizes.append(len(json.dumps(parameterSets, default=str)))
+        return batch_execute_statement(sql, parameterSets=parameterSets, **kwargs)
+
+    rds_data_client.batch_execute_statement = measure
+    storage.add_many([Widget(name=f'widget-{i}', payload=payload) for i in range(120)])
+
+    assert len(sizes) > 1
+    assert max(sizes) <= storage._batch_size_limit * 1024
+    assert len(storage.all(Widget)) == 120
+
+
+def test_key_scan_stays_under_the_response_limit_on_wide_keys(storage, rds_data_client):
+    rds_data_client._response_size_limit = 128 * 1024
+    storage._size_limit = 125
+    storage.add_many([Widget(name=f'{"n" * 150}-{i:05d}', size=i) for i in range(2000)])
+    storage._fetch_multiple_large_documents = None
+
+    streamed = [w.size for w in storage.all(Widget, ff.Attr('name') > 'a', stream=True)]
+    assert streamed == list(range(2000))
+    assert len(storage.all(Widget, ff.Attr('name') > 'a')) == 2000
+
+
+def test_ddl_only_refreshes_persistent_table_metadata(storage):
+    scans = []
+    get_average_row_size = storage._get_average_row_size
+    storage._get_average_row_size = lambda entity: scans.append(entity) or get_average_row_size(entity)
+
+    storage._execute_ddl(Widget)
+    assert scans == []
+
+    storage._s3_client = _S3Client()
+    storage._bucket = 'metadata'
+    storage._execute_ddl(Widget)
+    assert scans == [Widget]
+    assert set(storage._load_table_metadata(Widget).keys()) == {'average_row_size', 'updated_at'}
+
+    storage._get_table_metadata(Widget)
+    assert scans == [Widget]
+
+
+@pytest.fixture()
+def unit_of_work(storage):
+    ret = DataApiUnitOfWork()
+    ret._logger = _Logger()
+    storage._data_api_unit_of_work = ret
+    return ret
+
+
+def test_unit_of_work_flushes_writes_in_order(storage, unit_of_work):
+    widget = Widget(name='widget')
+    unit_of_work.begin()
+    storage.add(widget)
+    storage.remove(widget)
+    assert storage.find(widget.id, Widget) is None
+    unit_of_work.commit()
+
+    assert storage.find(widget.id, Widget) is None
+
+
+def test_unit_of_work_queues_bulk_writes(storage, unit_of_work):
+    widgets = [Widget(name=f'widget-{i}', size=i) for i in range(5)]
+    unit_of_work.begin()
+    storage.add_many(widgets)
+    assert storage.remove_where(Widget, ff.Attr('size') >= 3) is None
+    widgets[0].size = 10
+    storage.update_many([widgets[0]])
+    storage.remove_many([widgets[1]])
+    storage.add(Widget(name='last', size=3))
+    assert len(storage.all(Widget)) == 0
+    unit_of_work.commit()
+
+    assert sorted(w.size for w in storage.all(Widget)) == [2, 3, 10]
+
+
+def test_unit_of_work_rollback_discards_writes(storage, unit_of_work):
+    unit_of_work.begin()
+    storage.add(Widget(name='widget'))
+    unit_of_work.rollback()
+    unit_of_work.commit()
+
+    assert len(storage.all(Widget)) == 0
+    storage.add(Widget(name='widget'))
+    assert len(storage.all(Widget)) == 1
+
+
+def test_pages_follow_the_select_limit(storage):
+    storage.add_many([Widget(name=f'widget-{i:03d}', size=i) for i in range(100)])
+    storage._select_limits['Widget'] = 7
+    pages = []
+    load_page = storage._load_page
+
+    def spy(entity, sql, params, limit):
+        records, limit = load_page(entity, sql, params, limit)
+        pages.append(len(records or []))
+        return records, limit
+
+    storage._load_page = spy
+    assert sorted(w.size for w in storage.all(Widget)) == list(range(100))
+    assert sorted(w.size for w in storage.all(Widget, stream=True)) == list(range(100))
+    assert pages[0] == 7
+    assert len(storage.all(Widget, limit=5)) == 5
+
+
+def test_pages_shrink_when_the_response_limit_is_hit(storage, rds_data_client):
+    storage.add_many([Widget(name=f'widget-{i:03d}', size=i, payload='p' * 4000) for i in range(60)])
+    rds_data_client._response_size_limit = 64 * 1024
+    storage._select_limits['Widget'] = 50
+    overflows = []
+    observe_overflow = storage._observe_overflow
+    storage._observe_overflow = lambda entity, limit: overflows.append(limit) or observe_overflow(entity, limit)
+
+    assert sorted(w.size for w in storage.all(Widget)) == list(range(60))
+    assert overflows[0] == 50
+
+
+def test_documents_over_the_size_limit_are_written_and_read_in_chunks(storage, rds_data_client):
+    storage._size_limit = 4
+    rds_data_client._response_size_limit = 8 * 1024
+    small = Widget(name='small', size=1)
+    large = Widget(name='large', size=2, payload='x' * 20000)
+    chunked = []
+    insert_large_document = storage._insert_large_document
+    storage._insert_large_document = lambda entity, update=False: \
+        chunked.append(entity.id) or insert_large_document(entity, update=update)
+    storage.add_many([small, large])
+    assert chunked == [large.id]
+
+    assert storage.find(large.id, Widget).payload == 'x' * 20000
+    assert sorted(len(w.payload) for w in storage.all(Widget)) == [0, 20000]
+
+    large.payload = 'y' * 30000
+    storage.update(large)
+    assert chunked == [large.id, large.id]
+    assert storage.find(large.id, Widget).payload == 'y' * 30000
+
+
+def test_mapped_storage_round_trip(mapped_storage):
+    gadgets = [Gadget(name=f'gadget-{i}', size=i, weight=i / 2) for i in range(30)]
+    mapped_storage.add_many(gadgets)
+    gadgets[3].weight = 9.5
+    mapped_storage.update(gadgets[3])
+    mapped_storage.remove(gadgets[4])
+
+    assert len(mapped_storage.all(Gadget)) == 29
+    assert mapped_storage.find(gadgets[3].id, Gadget).weight == 9.5
+    assert sorted(g.size for g in mapped_storage.all(Gadget, ff.Attr('size') > 25)) == [26, 27, 28, 29]
+
+
+def test_projections_come_back_as_dicts_or_tuples(storage):
+    storage.add_many([Widget(name=f'widget-{i:02d}', size=i) for i in range(20)])
+
+    rows = storage.project(Widget, ['size', 'name'], ff.Attr('size') >= 17)
+    assert sorted(rows, key=lambda r: r['size']) == [
+        {'size': 17, 'name': 'widget-17'}, {'size': 18, 'name': 'widget-18'}, {'size': 19, 'name': 'widget-19'}
+    ]
+    assert sorted(storage.project(Widget, ['size', 'name'], ff.Attr('size') < 2, tuples=True)) == \
+        [(0, 'widget-00'), (1, 'widget-01')]
+    assert len(storage.project(Widget, ['name'], limit=5)) == 5
+
+
+def test_mapped_projections_decode_each_page_once(mapped_storage):
+    mapped_storage.add_many([Gadget(name=f'gadget-{i:02d}', size=i, weight=i / 4) for i in range(20)])
+    mapped_storage._select_limits['Gadget'] = 6
+    decoders = []
+    get_projection_decoder = mapped_storage._get_projection_decoder
+    mapped_storage._get_projection_decoder = lambda *args: decoders.append(args) or get_projection_decoder(*args)
+
+    rows = mapped_storage.project(Gadget, ['weight', 'name'])
+    assert sorted(rows, key=lambda r: r['name'])[5] == {'weight': 1.25, 'name': 'gadget-05'}
+    assert len(rows) == 20
+    # One decoder per page; the page size may grow while paging, so only the bounds are fixed.
+    assert 1 < len(decoders) <= 4
+    assert sorted(mapped_storage.project(Gadget, ['size', 'weight'], ff.Attr('size') > 17, tuples=True)) == \
+        [(18, 4.5), (19, 4.75)]
+
+
+def test_update_many_sets_updated_on(storage):
+    storage._execute_ddl(Document)
+    documents = [Document(name=f'document-{i}') for i in range(3)]
+    storage.add_many(documents)
+    before = datetime.now()
+
+    documents[0].name = 'renamed'
+    storage.update_many(documents[:2])
+
+    assert all(d.updated_on >= before for d in documents[:2])
+    stored = {d.id: d for d in storage.all(Document)}
+    assert stored[documents[0].id].name == 'renamed'
+    assert stored[documents[1].id].updated_on >= before
+    assert stored[documents[2].id].updated_on is None
+
+
+def test_remove_where_requires_criteria(storage, mapped_storage):
+    storage.add_many([Widget(name=f'widget-{i}') for i in range(10)])
+    mapped_storage.add_many([Gadget(name=f'gadget-{i}') for i in range(10)])
+
+    with pytest.raises(ff.InvalidArgument):
+        storage.remove_where(Widget, None)
+    with pytest.raises(ff.InvalidArgument):
+        mapped_storage.remove_where(Gadget, None)
+    assert len(storage.all(Widget)) == 10
+    assert len(mapped_storage.all(Gadget)) == 10
+
+
+def test_remove_many_soft_deletes_unless_forced(storage):
+    storage._execute_ddl(Document)
+    documents = [Document(name=f'document-{i}') for i in range(4)]
+    widgets = [Widget(name=f'widget-{i}') for i in range(2)]
+    storage.add_many(documents + widgets)
+
+    storage.remove_many(documents[:2] + widgets)
+    stored = {d.id: d for d in storage.all(Document)}
+    assert len(stored) == 4
+    assert all(stored[d.id].deleted_on is not None for d in documents[:2])
+    assert all(stored[d.id].deleted_on is None for d in documents[2:])
+    assert len(storage.all(Widget)) == 0
+
+    storage.remove_many(documents[2:], force=True)
+    assert sorted(d.id for d in storage.all(Document)) == sorted(d.id for d in documents[:2])
+
+
+def test_statements_inside_a_transaction_run_one_at_a_time(storage, rds_data_client, unit_of_work):
+    storage._page_concurrency = 4
+    storage._size_limit = 4
+    rds_data_client._response_size_limit = 8 * 1024
+    widgets = [Widget(name=f'widget-{i:03d}', size=i) for i in range(80)]
+    widgets += [Widget(name=f'large-{i}', size=100 + i, payload='x' * 20000) for i in range(2)]
+    storage.add_many(widgets)
+    storage._select_limits['Widget'] = 5
+
+    threads = set()
+    execute_statement = rds_data_client.execute_statement
+
+    def spy(**kwargs):
+        if kwargs.get('transactionId') is not None:
+            threads.add(threading.get_ident())
+        return execute_statement(**kwargs)
+
+    rds_data_client.execute_statement = spy
+    storage.begin_transaction()
+    assert len(storage.all(Widget)) == 82
+    assert len(storage.find_many(Widget, [w.id for w in widgets])) == 82
+    assert [len(w.payload) for w in storage.all(Widget, ff.Attr('size') >= 100)] == [20000, 20000]
+    storage.commit_transaction()
+    assert threads == {threading.get_ident()}
+
+    unit_of_work.begin()
+    storage.remove_where(Widget, ff.Attr('name').lower().startswith('widget'))
+    unit_of_work.commit()
+    assert sorted(w.size for w in storage.all(Widget)) == [100, 101]
+    assert threads == {threading.get_ident()}
+
+
+def test_find_many_returns_found_ids_once_in_the_order_given(storage):
+    widgets = [Widget(name=f'widget-{i}', size=i) for i in range(10)]
+    storage.add_many(widgets)
+    ids = [widgets[7].id, 'missing', widgets[2].id, widgets[7].id, widgets[5].id]
+
+    found = storage.find_many(Widget, ids)
+
+    assert list(found.keys()) == [widgets[7].id, widgets[2].id, widgets[5].id]
+    assert [w.size for w in found.values()] == [7, 2, 5]
+    assert storage.find_many(Widget, ['missing']) == {}
+    assert storage.find_many(Widget, []) == {}
+
+
+def test_find_many_chunks_past_the_id_list_limit(storage):
+    widgets = [Widget(name=f'widget-{i}', size=i) for i in range(50)]
+    storage.add_many(widgets)
+    storage._select_limits['Widget'] = 1000000
+    storage._id_list_limit = 7
+    chunks = []
+    load_ids = storage._load_ids
+    storage._load_ids = lambda entity, ids: chunks.append(len(ids)) or load_ids(entity, ids)
+
+    ids = [w.id for w in reversed(widgets)]
+    found = storage.find_many(Widget, ids)
+
+    assert list(found.keys()) == ids
+    assert chunks == [7] * 7 + [1]
+
+
+_READINGS = [
+    Reading(sensor='a', taken_on=datetime(2020, 5, 1, 12, 30, 15), value=1.5, count=3, attributes={'unit': 'C'}),
+    Reading(sensor='b', taken_on=None, value=None, count=None, attributes={}),
+    Reading(sensor='c', taken_on=datetime(2021, 1, 2), value=-0.000125, count=0, attributes={'tags': ['x', 'y']}),
+]
+
+
+def _read_value(type_: str, cell: dict):
+    # The per-cell decoding the cached row decoder replaced.
+    if 'isNull' in cell:
+        return None
+    keys = {'float': 'doubleValue', 'int': 'longValue', 'bool': 'booleanValue', 'bytes': 'blobValue'}
+    return cell[keys.get(type_, 'stringValue')]
+
+
+@pytest.mark.parametrize('cls', [DataApiMysqlMappedStorageInterface, DataApiMysqlStorageInterface])
+def test_compiled_parameter_encoders_match_generate_param_entry(cls):
+    storage = build_storage(cls)
+
+    for reading in _READINGS:
+        expected = [
+            storage._generate_param_entry(f.name, f.type, getattr(reading, f.name))
+            for f in storage._get_parameter_fields(Reading)
+        ]
+        encoded = [encode(getattr(reading, name)) for name, encode in storage._get_parameter_encoders(Reading)]
+        assert encoded == expected
+        # Encoders must not hand out shared dicts.
+        encoded[0]['value'].clear()
+        assert [encode(getattr(reading, name)) for name, encode in storage._get_parameter_encoders(Reading)] \
+            == expected
+
+
+def test_cached_row_decoder_matches_per_cell_decoding():
+    storage = build_storage(DataApiMysqlMappedStorageInterface)
+    visible = storage._visible_fields(Reading)
+    records = [
+        [{'stringValue': 'r1'}, {'stringValue': 'a'}, {'stringValue': '2020-05-01 12:30:15'},
+         {'doubleValue': 1.5}, {'longValue': 3}, {'stringValue': '{"unit": "C"}'}],
+        [{'stringValue': 'r2'}, {'stringValue': 'b'}, {'isNull': True}, {'isNull': True}, {'isNull': True},
+         {'stringValue': '{}'}],
+    ]
+
+    expected = [{f.name: _read_value(f.type, cell) for f, cell in zip(visible, row)} for row in records]
+    assert [f.name for f in visible] == ['id', 'sensor', 'taken_on', 'value', 'count', 'attributes']
+    assert storage._build_page(Reading, records, raw=True) == expected
+    assert storage._build_projection(Reading, ['value', 'taken_on'], [records[1][3], records[1][2]]) == \
+        {'value': None, 'taken_on': None}
+
+
+def test_mapped_rows_round_trip_nullable_datetime_and_float_fields(rds_data_client):
+    storage = build_storage(DataApiMysqlMappedStorageInterface, client=rds_data_client)
+    storage._execute_ddl(Gadget)
+    storage._execute_ddl(Document)
+    gadgets = [Gadget(name='light', size=0, weight=0.125), Gadget(name='heavy', size=-3, weight=1e6)]
+    documents = [Document(name='dated', updated_on=datetime(2020, 5, 1, 12, 30, 15)), Document(name='undated')]
+    storage.add_many(gadgets)
+    storage.add_many(documents)
+
+    found = storage.find_many(Gadget, [g.id for g in gadgets])
+    assert [(g.name, g.size, g.weight) for g in found.values()] == [('light', 0, 0.125), ('heavy', -3, 1e6)]
+    found = storage.find_many(Document, [d.id for d in documents])
+    assert [(d.name, d.updated_on, d.deleted_on) for d in found.values()] == \
+        [('dated', datetime(2020, 5, 1, 12, 30, 15), None), ('undated', None, None)]
+
+
+def test_statements_are_cached_per_bucket_of_id_counts(storage):
+    widgets = [Widget(name=f'widget-{i}', size=i) for i in range(100)]
+    storage.add_many(widgets)
+
+    for count in range(1, 101):
+        assert len(storage.find_many(Widget, [w.id for w in widgets[:count]])) == count
+    storage.remove_many(widgets[:3])
+    storage.remove_many(widgets[3:10])
+
+    statements = storage._cache['statements']
+    assert sorted(k[2] for k in statements if k[1] == 'find_many') == [1, 2, 4, 8, 16, 32, 64, 128]
+    assert sorted(k[2] for k in statements if k[1] == 'remove_ids') == [4, 8]
+    assert len(storage.all(Widget)) == 90
+
+
+def test_statement_cache_evicts_oldest_entries_under_concurrent_use(storage):
+    storage._statement_cache_size = 16
+    errors = []
+
+    def use(n: int):
+        try:
+            for i in range(500):
+                assert storage._statement((n, i % 40), lambda: f'select {n}, {i % 40}') == f'select {n}, {i % 40}'
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=use, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(storage._cache['statements']) <= 16
+    storage._statement(('first',), lambda: 'first')
+    storage._statement(('second',), lambda: 'second')
+    assert ('first',) in storage._cache['statements']
+
+
+@pytest.mark.parametrize('extra', [-1, 0, 1])
+def test_large_documents_are_reassembled_across_chunk_boundaries(storage, extra):
+    storage._size_limit = 1
+    chunk = storage._size_limit * 1024
+    widgets = []
+    for i, chunks in enumerate([1, 3, 4]):
+        widget = Widget(name=f'large-{i}', size=i)
+        target = chunks * chunk + extra - len(storage._encode_document(widget))
+        widget.payload = ''.join(f'{n:06d}' for n in range(target // 6 + 1))[:target]
+        assert len(storage._encode_document(widget)) == chunks * chunk + extra
+        widgets.append(widget)
+    storage.add_many(widgets)
+
+    ids = [widgets[2].id, 'missing', widgets[0].id, widgets[1].id]
+    documents = storage._fetch_large_documents(ids, Widget, raw=True)
+
+    assert [d['payload'] for d in documents] == [widgets[2].payload, widgets[0].payload, widgets[1].payload]
+
+
+def test_ranges_are_loaded_in_key_order_across_scan_and_page_boundaries(storage):
+    widgets = [Widget(name=f'widget-{i:03d}', size=i) for i in range(100)]
+    storage.add_many(widgets)
+    storage._page_concurrency = 3
+    storage._key_scan_size = 10
+    storage._select_limits['Widget'] = 7
+    ranges = []
+    load_range = storage._load_range
+    storage._load_range = lambda *args: ranges.append(len(args[6])) or load_range(*args)
+
+    assert [w.id for w in storage.all(Widget)] == sorted(w.id for w in widgets)
+    names = [w.name for w in storage.all(Widget, ff.Attr('name') >= 'widget-020', stream=True)]
+    assert names == [f'widget-{i:03d}' for i in range(20, 100)]
+    assert [w.id for w in storage.all(Widget, limit=45)] == sorted(w.id for w in widgets)[:45]
+    assert len(ranges) > 3
+
+
+def _rows(count: int, width: int):
+    return [[{'stringValue': 'x' * width}] for _ in range(count)]
+
+
+def test_page_limit_doubles_until_it_reaches_the_target(storage):
+    storage._size_limit = 100
+    storage._row_sizes['Widget'] = 1.0
+    storage._select_limits['Widget'] = 5
+    limits = []
+
+    for _ in range(12):
+        storage._observe_page(Widget, _rows(storage._get_select_limit(Widget), 180))
+        limits.append(storage._get_select_limit(Widget))
+
+    # 200 bytes per row, so pages settle at 100KB * 0.8 / ~0.2KB.
+    assert limits[:4] == [10, 20, 40, 80]
+    assert all(b <= a * 2 for a, b in zip(limits, limits[1:]))
+    assert limits[-1] == storage._target_limit('Widget')
+    assert 390 <= limits[-1] <= 410
+
+
+def test_page_limit_shrinks_on_overflows_and_larger_rows(storage):
+    storage._size_limit = 100
+    storage._row_sizes['Widget'] = 0.2
+    storage._select_limits['Widget'] = 400
+
+    storage._observe_overflow(Widget, 400)
+    assert storage._get_select_limit(Widget) == 200
+    assert storage._row_sizes['Widget'] == 0.25
+    storage._observe_overflow(Widget, 1)
+    storage._observe_overflow(Widget, 1)
+    assert storage._get_select_limit(Widget) == 1
+
+    storage._select_limits['Widget'] = 200
+    storage._row_sizes['Widget'] = 0.2
+    storage._observe_page(Widget, _rows(10, 4076))
+    # The estimate moves halfway to the observed 4KB rows, and the limit drops to the new target at once.
+    assert storage._row_sizes['Widget'] == pytest.approx(2.1)
+    assert storage._get_select_limit(Widget) == 38
+    storage._observe_page(Widget, [])
+    assert storage._get_select_limit(Widget) == 38
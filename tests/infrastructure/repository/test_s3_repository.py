@@ -0,0 +1,260 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import firefly as ff
+import firefly.infrastructure as ffi
+import firefly_di as di
+import pytest
+from botocore.exceptions import ClientError
+from firefly_aws.infrastructure.repository.s3_repository import S3Repository
+from firefly_aws.infrastructure.repository.s3_repository_factory import S3RepositoryFactory
+
+from tests.conftest import Widget, _Logger, _S3Client, _SplitAttribute
+
+
+class _Container(di.Container):
+    logger: ff.Logger = lambda self: _Logger()
+    serializer: ff.Serializer = ffi.JsonSerializer
+    s3_client = lambda self: self._s3_client
+
+    def __init__(self, s3_client):
+        super().__init__()
+        self._s3_client = s3_client
+
+
+class _Context:
+    config = {'bucket': 'bucket'}
+
+
+class _ContextMap:
+    def get_context(self, name: str):
+        return _Context()
+
+
+@pytest.fixture()
+def s3_client():
+    return _S3Client()
+
+
+@pytest.fixture()
+def repository(s3_client, monkeypatch):
+    # append, commit and execute_ddl are abstract in some firefly releases; these tests do not use them.
+    monkeypatch.setattr(S3Repository, '__abstractmethods__', frozenset())
+    factory = S3RepositoryFactory(s3_client)
+    factory._container = _Container(s3_client)
+    factory._context_map = _ContextMap()
+    ret = factory(Widget)
+    ret._max_workers = 4
+    return ret
+
+
+def _fail_object_writes(s3_client, repository):
+    put_object = s3_client.put_object
+
+    def put(Key: str, **kwargs):
+        if '/_index/' not in Key:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'failed'}}, 'PutObject')
+        return put_object(Key=Key, **kwargs)
+
+    s3_client.put_object = put
+    return put_object
+
+
+def test_manifests_list_every_stored_aggregate(repository, s3_client):
+    repository.add(Widget(id='a', name='x'))
+    assert repository._index_ready('name')
+    put_object = s3_client.put_object
+
+    def put(Key: str, **kwargs):
+        if '/_index/' in Key:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'failed'}}, 'PutObject')
+        return put_object(Key=Key, **kwargs)
+
+    s3_client.put_object = put
+    with pytest.raises(ff.RepositoryError):
+        repository.add(Widget(id='b', name='y'))
+    s3_client.put_object = put_object
+
+    assert repository.find('b') is None
+    assert repository._read_index('name') == {'a': 'x'}
+
+    _fail_object_writes(s3_client, repository)
+    with pytest.raises(ff.RepositoryError):
+        repository.add(Widget(id='c', name='z'))
+    s3_client.put_object = put_object
+
+    assert repository._read_index('name') == {'a': 'x'}
+    assert repository.find(lambda w: w.name == 'z') is None
+
+
+def test_failed_update_restores_the_old_index_entry(repository, s3_client):
+    repository.add(Widget(id='a', name='x'))
+
+    put_object = _fail_object_writes(s3_client, repository)
+    with pytest.raises(ff.RepositoryError):
+        repository.add(Widget(id='a', name='y'))
+    s3_client.put_object = put_object
+
+    assert repository._read_index('name') == {'a': 'x'}
+    assert repository.find(lambda w: w.name == 'x').id == 'a'
+
+
+def test_index_is_not_used_when_an_entry_cannot_be_restored(repository, s3_client):
+    repository.add(Widget(id='a', name='x'))
+    writes = []
+    put_object = s3_client.put_object
+
+    def put(Key: str, **kwargs):
+        writes.append(Key)
+        if '/_index/' not in Key or len(writes) > 1:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'failed'}}, 'PutObject')
+        return put_object(Key=Key, **kwargs)
+
+    s3_client.put_object = put
+    with pytest.raises(ff.RepositoryError):
+        repository.add(Widget(id='a', name='y'))
+    s3_client.put_object = put_object
+
+    assert not repository._index_ready('name')
+    assert repository.find(lambda w: w.name == 'x').id == 'a'
+    repository.rebuild_indexes()
+    assert repository._index_ready('name')
+
+
+def test_function_calls_are_not_answered_from_the_index(repository):
+    repository.add(Widget(id='a', name='X'))
+
+    assert repository._find_candidates(ff.Attr('name') == 'X', {}) == {'a'}
+    assert repository._find_candidates(ff.BinaryOp(_SplitAttribute('name', []), '==', 'X'), {}) == {'a'}
+    assert repository._find_candidates(ff.BinaryOp(_SplitAttribute('name', ['LOWER']), '==', 'x'), {}) is None
+    assert repository._find_candidates(ff.Attr('name').lower() == 'x', {}) is None
+
+
+def test_select_expressions(repository):
+    assert repository._select_expression((ff.Attr('size') > 3) & (ff.Attr('name') == "it's")) == \
+        '(s."size" > 3 AND s."name" = \'it\'\'s\')'
+    assert repository._select_expression(ff.Attr('name') != 'x') == '(s."name" <> \'x\' OR s."name" IS NULL)'
+    assert repository._select_expression(ff.Attr('name').is_in(['a', 'b'])) == 's."name" IN (\'a\', \'b\')'
+    assert repository._select_expression(ff.BinaryOp(_SplitAttribute('name', ['LOWER']), '==', 'x')) is None
+    assert repository._select_expression((ff.Attr('size') > 3) | (ff.Attr('name').lower() == 'x')) is None
+
+
+def _add_widgets(repository, count: int):
+    ret = [Widget(id=f'{i:03d}', name=f'widget-{i % 5}', size=i) for i in range(count)]
+    for widget in ret:
+        repository.add(widget)
+    return ret
+
+
+def test_listing_follows_continuation_tokens(repository):
+    repository._list_page_size = 3
+    _add_widgets(repository, 10)
+
+    assert len(repository) == 10
+    assert [w.size for w in repository[2:5]] == [2, 3, 4]
+    assert repository[7].size == 7
+    assert sorted(w.size for w in repository) == list(range(10))
+
+
+def test_indexed_queries_only_read_candidates(repository, s3_client):
+    _add_widgets(repository, 20)
+    s3_client.calls = {}
+
+    assert sorted(w.size for w in repository.filter(lambda w: w.name == 'widget-3')) == [3, 8, 13, 18]
+    assert s3_client.calls['get_object'] == repository._index_shards + 4
+    assert sorted(w.size for w in repository.filter(lambda w: (w.name == 'widget-3') & (w.size > 10))) == [13, 18]
+    assert sorted(w.size for w in repository.filter(lambda w: w.size > 16)) == [17, 18, 19]
+
+
+def test_full_scans_read_the_snapshot_and_later_writes(repository, s3_client):
+    repository._snapshots = True
+    repository._segment_size = 1
+    repository._range_size = 1
+    repository._delta_margin = 0
+    widgets = _add_widgets(repository, 30)
+    repository.compact()
+
+    repository.remove(widgets[0])
+    widgets[1].size = 100
+    repository.add(widgets[1])
+    repository.add(Widget(id='new', name='new', size=200))
+    s3_client.calls = {}
+
+    sizes = sorted(w.size for w in repository)
+    assert sizes == sorted(list(range(2, 30)) + [100, 200])
+    # The snapshot manifest, one ranged GET per segment here, and the two aggregates written since.
+    assert s3_client.calls['get_object'] == 1 + 3 + 2
+    assert sorted(w.size for w in repository.filter(lambda w: w.size >= 100)) == [100, 200]
+
+    repository.compact()
+    assert sorted(w.size for w in repository) == sizes
+
+
+def test_snapshot_manifests_list_record_aligned_blocks(repository, s3_client):
+    repository._snapshots = True
+    repository._segment_size = 8
+    repository._range_size = 1
+    widgets = [Widget(name=f'widget-{i}', size=i, payload='p' * 300) for i in range(100)]
+    for widget in widgets:
+        repository.add(widget)
+    repository.compact()
+
+    snapshot = repository._get_snapshot()
+    assert len(snapshot['segments']) > 1
+    for segment in snapshot['segments']:
+        body = s3_client.get_object(Bucket='bucket', Key=segment['key'])['Body'].read()
+        assert 'records' not in segment
+        assert len(segment['blocks']) < body.count(b'\n')
+        assert segment['blocks'][0][0] == 0 and segment['blocks'][-1][1] == segment['size'] - 1
+        for (_, end), (start, _) in zip(segment['blocks'], segment['blocks'][1:]):
+            assert start == end + 1 and body[end:end + 1] == b'\n'
+    assert sorted(w.size for w in repository) == list(range(100))
+
+
+def test_reduce_folds_every_aggregate(repository):
+    assert repository.reduce(lambda a, b: a if a.size >= b.size else b) is None
+    _add_widgets(repository, 40)
+
+    # Arrival order varies, so only commutative and associative callbacks give a stable result.
+    assert repository.reduce(lambda a, b: a if a.size >= b.size else b).size == 39
+    assert repository.reduce(lambda a, b: a if a.id <= b.id else b).id == '000'
+
+
+def test_find_by_id_revalidates_cached_aggregates(repository, s3_client):
+    widget = _add_widgets(repository, 1)[0]
+    assert repository.find(widget.id).size == 0
+    found = repository.find(widget.id)
+    found.size = 5
+    assert repository.find(widget.id).size == 0
+    assert len(repository._entity_cache) == 1
+
+    s3_client.put_object(Bucket='bucket', Key=repository._key(widget.id), Body=ffi.JsonSerializer().serialize(
+        Widget(id=widget.id, name='changed', size=7).to_dict()
+    ))
+    assert repository.find(widget.id).size == 7
+    repository.remove(widget)
+    assert repository.find(widget.id) is None
+
+
+def test_select_falls_back_to_reading_objects(repository, s3_client):
+    repository._select = True
+    _add_widgets(repository, 5)
+
+    def select_object_content(**kwargs):
+        raise ClientError({'Error': {'Code': 'InvalidQuery', 'Message': 'failed'}}, 'SelectObjectContent')
+
+    s3_client.select_object_content = select_object_content
+    assert sorted(w.size for w in repository.filter(lambda w: w.size >= 3)) == [3, 4]
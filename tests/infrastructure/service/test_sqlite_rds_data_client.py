@@ -0,0 +1,109 @@
+#  Copyright (c) 2020 JD Williams
+#
+#  This file is part of Firefly, a Python SOA framework built by JD Williams. Firefly is free software; you can
+#  redistribute it and/or modify it under the terms of the GNU General Public License as published by the
+#  Free Software Foundation; either version 3 of the License, or (at your option) any later version.
+#
+#  Firefly is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+#  implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+#  Public License for more details. You should have received a copy of the GNU Lesser General Public
+#  License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  You should have received a copy of the GNU General Public License along with Firefly. If not, see
+#  <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import pytest
+from botocore.exceptions import ClientError
+from firefly_aws.infrastructure import SqliteRdsDataClient
+
+
+@pytest.fixture()
+def client():
+    ret = SqliteRdsDataClient()
+    ret.execute_statement('create database if not exists tests')
+    ret.execute_statement('create table if not exists tests.items (id varchar(40) primary key, body text)')
+    return ret
+
+
+def _insert(client, id_: str, body: str, **kwargs):
+    return client.execute_statement('insert into tests.items (id, body) values (:id, :body)', parameters=[
+        {'name': 'id', 'value': {'stringValue': id_}},
+        {'name': 'body', 'value': {'stringValue': body}},
+    ], **kwargs)
+
+
+def test_records_use_data_api_values(client):
+    _insert(client, 'a', 'x')
+    client.execute_statement('insert into tests.items (id, body) values (:id, :body)', parameters=[
+        {'name': 'id', 'value': {'stringValue': 'b'}},
+        {'name': 'body', 'value': {'isNull': True}},
+    ])
+
+    result = client.execute_statement('select id, body, CHAR_LENGTH(id) from tests.items order by id')
+    assert result['records'] == [
+        [{'stringValue': 'a'}, {'stringValue': 'x'}, {'longValue': 1}],
+        [{'stringValue': 'b'}, {'isNull': True}, {'longValue': 1}],
+    ]
+
+
+def test_responses_over_the_limit_are_rejected(client):
+    client._response_size_limit = 1024
+    _insert(client, 'a', 'x' * 2000)
+
+    with pytest.raises(ClientError, match='Database returned more than the allowed response size limit'):
+        client.execute_statement('select body from tests.items')
+    assert client.execute_statement('select id from tests.items')['records'] == [[{'stringValue': 'a'}]]
+
+
+def test_batches_over_the_request_limit_are_rejected(client):
+    client._request_size_limit = 1024
+    parameter_sets = [
+        [{'name': 'id', 'value': {'stringValue': str(i)}}, {'name': 'body', 'value': {'stringValue': 'x' * 100}}]
+        for i in range(20)
+    ]
+
+    sql = 'insert into tests.items (id, body) values (:id, :body)'
+
+    with pytest.raises(ClientError, match='Request payload size exceeded'):
+        client.batch_execute_statement(sql, parameterSets=parameter_sets)
+    client.batch_execute_statement(sql, parameterSets=parameter_sets[:5])
+    assert len(client.execute_statement('select id from tests.items')['records']) == 5
+
+
+def test_failed_batches_are_rolled_back(client):
+    _insert(client, '3', 'x')
+    parameter_sets = [[{'name': 'id', 'value': {'stringValue': str(i)}}] for i in range(5)]
+
+    with pytest.raises(ClientError):
+        client.batch_execute_statement('insert into tests.items (id) values (:id)', parameterSets=parameter_sets)
+    assert len(client.execute_statement('select id from tests.items')['records']) == 1
+
+
+def test_transactions(client):
+    transaction_id = client.begin_transaction()['transactionId']
+    with pytest.raises(ClientError):
+        client.begin_transaction()
+    _insert(client, 'a', 'x', transactionId=transaction_id)
+    client.rollback_transaction(transactionId=transaction_id)
+    assert client.execute_statement('select id from tests.items')['records'] == []
+
+    transaction_id = client.begin_transaction()['transactionId']
+    _insert(client, 'b', 'x', transactionId=transaction_id)
+    client.commit_transaction(transactionId=transaction_id)
+    with pytest.raises(ClientError):
+        client.commit_transaction(transactionId=transaction_id)
+    assert client.execute_statement('select id from tests.items')['records'] == [[{'stringValue': 'b'}]]
+
+
+def test_index_names_are_scoped_to_their_table(client):
+    client.execute_statement('create table if not exists tests.others (id varchar(40) primary key, body text)')
+    client.execute_statement('create index `idx_body` on tests.items (`body`)')
+    client.execute_statement('create index `idx_body` on tests.others (`body`)')
+
+    sql = "select COLUMN_NAME from information_schema.statistics where TABLE_NAME = '{}' and TABLE_SCHEMA = 'tests'"
+    assert client.execute_statement(sql.format('others'))['records'] == [[{'stringValue': 'body'}]]
+    client.execute_statement('drop index `idx_body` on tests.items')
+    assert client.execute_statement(sql.format('items'))['records'] == []
+    assert client.execute_statement(sql.format('others'))['records'] == [[{'stringValue': 'body'}]]